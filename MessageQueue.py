@@ -0,0 +1,195 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from os import environ
+from typing import Any, Awaitable, Callable
+
+from aiogram.utils.exceptions import RetryAfter
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class MessageQueue:
+    # Outgoing messages wait here instead of in the handlers. Workers take the chats with pending
+    # messages in turn, each send needs a token from the global bucket and one from the bucket of
+    # its chat, and a chat hit by RetryAfter is put aside for the time Telegram asked for. A chat
+    # has at most one message in flight, so its messages arrive in the order they were queued.
+    latency_window = 1000
+    prune_size = 1024
+
+    def __init__(self, send: Callable[[Any, str], Awaitable[Any]]):
+        self.workers = int(environ.get("TELEGRAM_WORKERS", 4))
+        self.chat_rate = float(environ.get("TELEGRAM_CHAT_RATE", 1))
+        self.chat_burst = float(environ.get("TELEGRAM_CHAT_BURST", 3))
+        rate = float(environ.get("TELEGRAM_RATE", 26))
+        self._send = send
+        self._global = TokenBucket(rate, rate)
+        self._buckets: dict[Any, TokenBucket] = dict()
+        self._messages: dict[Any, deque[tuple[str, float]]] = dict()
+        self._chats: deque = deque()
+        self._sending: set = set()
+        self._condition = asyncio.Condition()
+        self._tasks: list[asyncio.Task] = []
+        self._latencies: deque[float] = deque(maxlen=self.latency_window)
+        self.depth = 0
+        self.peak_depth = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def __str__(self):
+        return f"depth {self.depth} (peak {self.peak_depth}), {len(self._chats)} chats, " \
+               f"sent {self.sent}, failed {self.failed}, retried {self.retried}, " \
+               f"latency p50 {self.latency(0.5):.2f} s, p95 {self.latency(0.95):.2f} s"
+
+    def latency(self, quantile: float) -> float:
+        if not self._latencies:
+            return 0.0
+        latencies = sorted(self._latencies)
+        return latencies[min(int(quantile * len(latencies)), len(latencies) - 1)]
+
+    async def put(self, chat_id: Any, text: str):
+        async with self._condition:
+            if chat_id not in self._messages:
+                self._messages[chat_id] = deque()
+                self._chats.append(chat_id)
+            self._messages[chat_id].append((text, time.monotonic()))
+            self.depth += 1
+            self.peak_depth = max(self.peak_depth, self.depth)
+            if chat_id not in self._buckets:
+                if len(self._buckets) >= self.prune_size:
+                    self._prune()
+                self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            self._condition.notify_all()
+
+    def _prune(self):
+        now = time.monotonic()
+        # A chat with a message in flight keeps its bucket, RetryAfter still needs it
+        for chat_id in [i for i, j in self._buckets.items()
+                        if i not in self._messages and i not in self._sending and j.full(now)]:
+            del self._buckets[chat_id]
+
+    async def _next(self) -> tuple[Any, str, float]:
+        async with self._condition:
+            while True:
+                await self._condition.wait_for(lambda: self._chats)
+                now = time.monotonic()
+                delay = self._global.delay(now)
+                if delay <= 0:
+                    for _ in range(len(self._chats)):
+                        chat_id = self._chats.popleft()
+                        if chat_id in self._sending or self._buckets[chat_id].delay(now) > 0:
+                            self._chats.append(chat_id)
+                            continue
+                        self._global.take(now)
+                        self._buckets[chat_id].take(now)
+                        text, queued = self._messages[chat_id].popleft()
+                        if self._messages[chat_id]:
+                            self._chats.append(chat_id)
+                        else:
+                            del self._messages[chat_id]
+                        self.depth -= 1
+                        self.in_flight += 1
+                        self._sending.add(chat_id)
+                        return chat_id, text, queued
+                    # Chats with a message in flight wait for the worker sending it to notify
+                    delay = min((self._buckets[i].delay(now) for i in self._chats if i not in self._sending),
+                                default=None)
+                try:
+                    await asyncio.wait_for(self._condition.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _retry(self, chat_id: Any, text: str, queued: float, timeout: float):
+        async with self._condition:
+            if chat_id not in self._buckets:
+                self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id].blocked_until = time.monotonic() + timeout
+            if chat_id not in self._messages:
+                self._messages[chat_id] = deque()
+                self._chats.append(chat_id)
+            self._messages[chat_id].appendleft((text, queued))
+            self.depth += 1
+            self.retried += 1
+            self._condition.notify_all()
+
+    async def _worker(self):
+        while True:
+            chat_id, text, queued = await self._next()
+            try:
+                try:
+                    await self._send(chat_id, text)
+                except RetryAfter as e:
+                    await self._retry(chat_id, text, queued, e.timeout)
+                except Exception:
+                    self.failed += 1
+                    print(datetime.now().isoformat())
+                    print(f"Failed to send a message to {chat_id}")
+                    print(traceback.format_exc())
+                else:
+                    self.sent += 1
+                    self._latencies.append(time.monotonic() - queued)
+            except Exception:
+                # The worker has to outlive its own bugs, otherwise the queue silently loses a worker
+                print(datetime.now().isoformat())
+                print("Message queue worker failed")
+                print(traceback.format_exc())
+            finally:
+                async with self._condition:
+                    self.in_flight -= 1
+                    self._sending.discard(chat_id)
+                    self._condition.notify_all()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        # Whatever is still queued after timeout is dropped
+        try:
+            async with self._condition:
+                await asyncio.wait_for(self._condition.wait_for(lambda: not self.depth and not self.in_flight), timeout)
+        except asyncio.TimeoutError:
+            print(f"Dropped {self.depth} queued messages")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
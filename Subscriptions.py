@@ -0,0 +1,139 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import json
+import os
+import tempfile
+import traceback
+from datetime import datetime
+from os import environ
+from typing import Any, Awaitable, Callable, Optional
+
+from parsers import BaseParser, Snapshot
+
+
+class Subscriptions:
+    # Chats subscribed to a SNILS, kept next to the snapshots between restarts. Every complete
+    # snapshot a parser publishes is compared with its previous one for the subscribed SNILS, and
+    # notify gets the ones whose rank or prediction changed, grouped by chat.
+    def __init__(self, parsers: list[BaseParser],
+                 notify: Callable[[BaseParser, dict[Any, list[str]]], Awaitable[Any]]):
+        self.per_chat = int(environ.get("SUBSCRIPTIONS_PER_CHAT", 10))
+        self.parsers = parsers
+        self._notify = notify
+        self._chats: dict[str, set[Any]] = dict()
+        self._snapshots: dict[BaseParser, Optional[Snapshot]] = {
+            parser: parser.snapshot if parser.complete else None for parser in parsers}
+        self._tasks: set[asyncio.Task] = set()
+        self._save_lock = asyncio.Lock()
+        self._changes = 0
+        self._saved = 0
+        for parser in parsers:
+            parser.add_publish_callback(self._published)
+
+    @property
+    def path(self):
+        return os.path.join(environ.get("SNAPSHOT_DIR", "snapshots"), "subscriptions.json")
+
+    def __len__(self) -> int:
+        return sum(len(i) for i in self._chats.values())
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self._chats = {app_id: set(chats) for app_id, chats in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print("Failed to load subscriptions")
+            print(traceback.format_exc())
+
+    def _save(self, state: dict[str, list[Any]]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    async def save(self):
+        # One save at a time, each writes the latest state, so saves queued behind it have nothing left to do
+        async with self._save_lock:
+            changes = self._changes
+            if changes == self._saved:
+                return
+            try:
+                await asyncio.to_thread(self._save, {app_id: list(chats) for app_id, chats in self._chats.items()})
+                self._saved = changes
+            except Exception:
+                print("Failed to save subscriptions")
+                print(traceback.format_exc())
+
+    def of(self, chat_id: Any) -> list[str]:
+        return [app_id for app_id, chats in self._chats.items() if chat_id in chats]
+
+    async def add(self, chat_id: Any, app_id: str) -> bool:
+        if chat_id in self._chats.get(app_id, ()) or len(self.of(chat_id)) >= self.per_chat:
+            return False
+        self._chats.setdefault(app_id, set()).add(chat_id)
+        self._changes += 1
+        await self.save()
+        return True
+
+    async def remove(self, chat_id: Any, app_id: str) -> bool:
+        if chat_id not in self._chats.get(app_id, ()):
+            return False
+        self._chats[app_id].discard(chat_id)
+        if not self._chats[app_id]:
+            del self._chats[app_id]
+        self._changes += 1
+        await self.save()
+        return True
+
+    def _published(self, parser: BaseParser):
+        snapshot = parser.snapshot
+        if not snapshot.complete or snapshot is self._snapshots[parser]:
+            return
+        previous, self._snapshots[parser] = self._snapshots[parser], snapshot
+        if previous is None or not self._chats:
+            return
+        task = asyncio.create_task(self._diff(parser, previous, snapshot))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _changed(previous: Snapshot, snapshot: Snapshot, app_ids: set[str]) -> set[str]:
+        # Only the subscribed SNILS are looked up, nothing is kept between updates
+        return {app_id for app_id in app_ids
+                if previous.applicants.positions(app_id) != snapshot.applicants.positions(app_id)}
+
+    async def _diff(self, parser: BaseParser, previous: Snapshot, snapshot: Snapshot):
+        try:
+            changed = await asyncio.to_thread(self._changed, previous, snapshot, set(self._chats.keys()))
+            batches: dict[Any, list[str]] = dict()
+            for app_id in changed:
+                for chat_id in self._chats.get(app_id, ()):
+                    batches.setdefault(chat_id, []).append(app_id)
+            if batches:
+                await self._notify(parser, batches)
+        except Exception:
+            print(datetime.now().isoformat())
+            print(f"Failed to notify subscribers of {parser.name}")
+            print(traceback.format_exc())
+
+    async def stop(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
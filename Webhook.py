@@ -0,0 +1,95 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import traceback
+from datetime import datetime
+from os import environ
+from typing import Optional
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+
+class Webhook:
+    # Telegram posts updates to an aiohttp app instead of being polled. Requests only put the update
+    # into a bounded queue, a fixed number of workers run the handlers, and a full queue makes
+    # Telegram wait instead of piling up handlers.
+    def __init__(self, dp: Dispatcher):
+        self.url = environ["WEBHOOK_URL"]
+        self.path = environ.get("WEBHOOK_PATH", "/webhook")
+        self.host = environ.get("WEBHOOK_HOST", "0.0.0.0")
+        self.port = int(environ.get("WEBHOOK_PORT", 8080))
+        self.secret = environ.get("WEBHOOK_SECRET") or None
+        self.concurrency = int(environ.get("WEBHOOK_CONCURRENCY", 32))
+        self.dp = dp
+        self._queue: asyncio.Queue[types.Update] = asyncio.Queue(int(environ.get("WEBHOOK_QUEUE_SIZE", 1000)))
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: list[asyncio.Task] = []
+        self.received = 0
+        self.handled = 0
+        self.failed = 0
+
+    def __str__(self):
+        return f"received {self.received}, handled {self.handled}, failed {self.failed}, queued {self._queue.qsize()}"
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        return app
+
+    async def start(self, set_webhook: bool = True):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        if set_webhook:
+            await self.dp.bot.set_webhook(self.url.rstrip("/") + self.path, secret_token=self.secret)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if self.secret is not None and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+        update = types.Update(**await request.json())
+        self.received += 1
+        await self._queue.put(update)
+        return web.Response()
+
+    async def _worker(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.process_update(update)
+            except Exception:
+                self.failed += 1
+                print(datetime.now().isoformat())
+                print(traceback.format_exc())
+            else:
+                self.handled += 1
+            finally:
+                self._queue.task_done()
+
+    async def stop(self, timeout: float = 10):
+        # No new requests are accepted, the queued updates are still handled for up to timeout
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Dropped {self._queue.qsize()} queued updates")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
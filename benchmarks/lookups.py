@@ -0,0 +1,66 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# Time of one get_applicant for the first, middle and last applicant of SPECS specs with APPLICANTS
+# applicants each, next to the list.index scan it replaced. Run from the repository root:
+# python benchmarks/lookups.py
+import asyncio
+import os
+import sys
+import timeit
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsers import BaseParser
+from parsers.allocation import shutdown_executor
+
+SPECS = int(os.environ.get("SPECS", 3))
+APPLICANTS = int(os.environ.get("APPLICANTS", 50000))
+NUMBER = int(os.environ.get("NUMBER", 200))
+
+
+def scan(applicants: dict[str, dict[int, list[Any]]], final_lists: dict[Any, list[str]],
+         app_id: str) -> tuple[dict[int, list[Any]], list[Any]]:
+    # get_applicant before the position index
+    positions = applicants[app_id]
+    return positions, [final_lists[i[0]].index(app_id) if app_id in final_lists[i[0]] else None
+                       for i in positions.values()]
+
+
+async def prepare() -> tuple[BaseParser, dict[str, dict[int, list[Any]]], dict[Any, list[str]]]:
+    parser = BaseParser()
+    parser._specs = {i: {"places": 100, "places_target": 0, "places_spec": 0, "places_sep": 0, "bvi": 0}
+                     for i in range(SPECS)}
+    applicants = {f"{n:011d}": {k + 1: [k, 200, n + 1] for k in range(SPECS)} for n in range(APPLICANTS)}
+    concurs_lists = {i: list(applicants) for i in range(SPECS)}
+    places = {i: parser._places_base(i) for i in range(SPECS)}
+    parser._publish(await parser.process_concurs_lists(applicants, concurs_lists, places))
+    return parser, applicants, {i: parser.applicants.concurs_list(i) for i in range(SPECS)}
+
+
+def main():
+    parser, applicants, final_lists = asyncio.run(prepare())
+    shutdown_executor()
+    print(f"{SPECS} specs x {APPLICANTS} applicants")
+    print(f"{'applicant':12}{'scan, us':>12}{'index, us':>12}")
+    for n in (0, APPLICANTS // 2, APPLICANTS - 1):
+        app_id = f"{n:011d}"
+        assert scan(applicants, final_lists, app_id) == parser.get_applicant(app_id)
+        times = [min(timeit.repeat(lookup, number=NUMBER, repeat=3)) / NUMBER * 10 ** 6
+                 for lookup in (lambda: scan(applicants, final_lists, app_id), lambda: parser.get_applicant(app_id))]
+        print(f"{n:<12}{times[0]:>12.1f}{times[1]:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# Writes the list pages in benchmarks/fixtures: the markup of every university with made up applicants,
+# so the benchmarks run on the same input everywhere. The pages are not committed, tables_backends.py
+# writes them on its first run; run this directly to write them again after changing it.
+import os
+import random
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def snils(r: random.Random) -> str:
+    return f"{r.randint(100, 999)}-{r.randint(100, 999)}-{r.randint(100, 999)} {r.randint(10, 99)}"
+
+
+def cells(row: list[str], indent: str = "    ") -> str:
+    return "".join(f"{indent}<td class=\"cell\">{i}</td>\n" for i in row)
+
+
+def page(title: str, body: str) -> str:
+    return f"<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n<title>{title}</title>\n</head>\n" \
+           f"<body>\n<div class=\"header\"><a href=\"/\">Главная</a></div>\n{body}\n" \
+           f"<div class=\"footer\">Приёмная комиссия</div>\n</body>\n</html>\n"
+
+
+def mpei(r: random.Random, count: int) -> str:
+    rows = ""
+    for n in range(1, count + 1):
+        row = [f"ID: {snils(r).replace('-', '').replace(' ', '')}", str(r.randint(150, 310))] + \
+              [str(r.randint(40, 100)) for _ in range(8)] + ["Да", str(r.randint(1, 5)), "Оригинал", "—"]
+        rows += f"<tr class=\"accepted\">\n{cells(row)}</tr>\n"
+    return page("Списки поступающих", f"<table class=\"list\">\n<tr><th>Поступающий</th><th>Сумма</th></tr>\n"
+                                      f"{rows}</table>")
+
+
+def mirea(r: random.Random, count: int) -> str:
+    rows = ""
+    for n in range(1, count + 1):
+        row = [str(n), snils(r), str(r.randint(1, 5)), "Да", "Нет"] + [str(r.randint(40, 100)) for _ in range(5)] + \
+              [str(r.randint(150, 310)), "Бюджет"]
+        rows += f"<tr>\n{cells(row)}</tr>\n"
+    return page("Конкурсный список", f"<table class=\"names\">\n{rows}</table>")
+
+
+def stankin(r: random.Random, count: int) -> str:
+    rows = "<tr><th>№</th><th>СНИЛС</th></tr>\n"
+    for n in range(1, count + 1):
+        row = [str(n), snils(r), "Очная", str(r.randint(1, 5)), "Подано", "Да", str(r.randint(150, 310))]
+        rows += f"<tr>\n{cells(row)}</tr>\n"
+    return page("Списки поступающих", f"<table class=\"grid\">\n<tbody>\n{rows}</tbody>\n</table>")
+
+
+def mai(r: random.Random, count: int) -> str:
+    def table(heading: str, count: int) -> str:
+        rows = "<tr><th>№</th><th>СНИЛС</th></tr>\n"
+        for n in range(1, count + 1):
+            row = [str(n), snils(r), str(r.randint(150, 310))] + [str(r.randint(40, 100)) for _ in range(3)] + \
+                  ["Да", "Нет", str(r.randint(1, 5))]
+            rows += f"<tr>\n{cells(row)}</tr>\n"
+        return f"<h4 class=\"mt-5 mb-3\">{heading}</h4>\n<table class=\"table\">\n{rows}</table>\n"
+
+    return page("Рейтинг", "<p>Конкурсная группа</p>\n"
+                           "<p>Количество мест: 120\nИз них по особой квоте: 12\n"
+                           "Из них по отдельной квоте: 12\nИз них по целевой квоте: 10</p>\n"
+                + table("Лица, поступающие без вступительных экзаменов", count // 100)
+                + table("Лица, поступающие по особой квоте", count // 20)
+                + table("Лица, поступающие по общему конкурсу", count))
+
+
+def mtuci(r: random.Random, count: int) -> str:
+    spans = "".join(f"<span title=\"{i}\">{j}</span>\n" for i, j in (("Бюджетное финансирование", 150),
+                                                                       ("Целевое обучение", 15),
+                                                                       ("Особая квота", 15),
+                                                                       ("Отдельная квота", 15)))
+    rows = "<tr><th>№</th></tr>\n"
+    for n in range(1, count + 1):
+        row = [str(n), snils(r)] + [str(r.randint(40, 100)) for _ in range(5)] + \
+              [str(r.randint(150, 310)), "Да", f"{r.randint(1, 5)} / 5", "Нет"]
+        rows += f"<tr>\n{cells(row)}</tr>\n"
+    return page("Списки", f"<div class=\"places\">\n{spans}</div>\n<table class=\"table\">\n{rows}</table>")
+
+
+def main():
+    r = random.Random(2023)
+    os.makedirs(FIXTURES, exist_ok=True)
+    for name, make, count in (("mpei", mpei, 3000), ("mirea", mirea, 3000), ("stankin", stankin, 50),
+                              ("mai", mai, 1500), ("mtuci", mtuci, 1500)):
+        with open(os.path.join(FIXTURES, f"{name}.html"), "w", encoding="utf-8") as f:
+            f.write(make(r, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# Rows per second of every installed HTML backend on the pages in benchmarks/fixtures, through the
+# same parse functions the parsers use. Run from the repository root: python benchmarks/tables_backends.py
+import os
+import sys
+import time
+from functools import partial
+from typing import Any, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import make_fixtures
+from parsers import tables
+from parsers.MAIParser import MAIParser
+from parsers.MIREAParser import MIREAParser
+from parsers.MPEIParser import MPEIParser, Types
+from parsers.MTUCIParser import MTUCIParser
+from parsers.STANKINParser import STANKINParser
+
+FIXTURES = make_fixtures.FIXTURES
+REPEAT = int(os.environ.get("REPEAT", 5))
+
+
+def extract(body: bytes, parse: Callable[[list[tables.Table]], Any], row_class: str = None,
+            recursive: bool = True) -> Any:
+    # What _fetch_tables does with a downloaded body
+    extractor = tables.backend.extractor(row_class, recursive, "utf-8")
+    for i in range(0, len(body), 64 * 1024):
+        extractor.feed(body[i:i + 64 * 1024])
+    return parse(extractor.close())
+
+
+CASES = {
+    "mpei": lambda body: extract(body, partial(MPEIParser._parse_tables, list_type=Types.base), "accepted"),
+    "mirea": lambda body: extract(body, MIREAParser._parse_tables, recursive=False),
+    "stankin": lambda body: STANKINParser._parse_page(body.decode(), 1),
+    "mai": lambda body: [j for _, i in MAIParser._parse_page(body.decode())[1] for j in i],
+    "mtuci": lambda body: MTUCIParser._parse_page(body.decode())[1],
+}
+
+
+def main():
+    if not all(os.path.exists(os.path.join(FIXTURES, f"{name}.html")) for name in CASES):
+        make_fixtures.main()
+    print(f"{'page':10}{'backend':10}{'rows':>8}{'rows/s':>12}")
+    for name, case in CASES.items():
+        with open(os.path.join(FIXTURES, f"{name}.html"), "rb") as f:
+            body = f.read()
+        results = {}
+        for backend in tables.backends.values():
+            tables.backend = backend
+            result = case(body)
+            rows = len(result)
+            started = time.perf_counter()
+            for _ in range(REPEAT):
+                case(body)
+            elapsed = (time.perf_counter() - started) / REPEAT
+            results[backend.name] = result
+            print(f"{name:10}{backend.name:10}{rows:>8}{rows / elapsed:>12.0f}")
+        if any(i != next(iter(results.values())) for i in results.values()):
+            print(f"{name}: backends returned different rows")
+
+
+if __name__ == '__main__':
+    main()
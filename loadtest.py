@@ -0,0 +1,82 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# Local load test of the webhook mode: serves Webhook with a dispatcher whose handler only sleeps
+# for HANDLER_DELAY seconds, posts UPDATES synthetic message updates over CONNECTIONS connections
+# and prints how many updates were handled per second. Nothing is sent to Telegram.
+import asyncio
+import time
+from os import environ
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+
+environ.setdefault("WEBHOOK_URL", "http://127.0.0.1")
+environ.setdefault("WEBHOOK_HOST", "127.0.0.1")
+environ.setdefault("WEBHOOK_PORT", "8081")
+
+from Webhook import Webhook
+
+UPDATES = int(environ.get("UPDATES", 5000))
+CONNECTIONS = int(environ.get("CONNECTIONS", 40))
+HANDLER_DELAY = float(environ.get("HANDLER_DELAY", 0.01))
+
+
+def update(n: int) -> dict:
+    return {"update_id": n,
+            "message": {"message_id": n, "date": int(time.time()),
+                        "chat": {"id": n % 1000, "type": "private"},
+                        "from": {"id": n % 1000, "is_bot": False, "first_name": "test"},
+                        "text": f"{10 ** 10 + n}"}}
+
+
+async def main():
+    dp = Dispatcher(Bot(token="123456:" + "a" * 35))
+    webhook = Webhook(dp)
+    active = 0
+    peak = 0
+
+    async def handler(_: types.Message):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(HANDLER_DELAY)
+        active -= 1
+
+    dp.register_message_handler(handler)
+    await webhook.start(set_webhook=False)
+    url = f"http://{webhook.host}:{webhook.port}{webhook.path}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": webhook.secret} if webhook.secret else {}
+    updates = iter(range(UPDATES))
+
+    async def client(session: aiohttp.ClientSession):
+        for n in updates:
+            async with session.post(url, json=update(n), headers=headers) as resp:
+                resp.raise_for_status()
+
+    started = time.monotonic()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=CONNECTIONS)) as session:
+        await asyncio.gather(*[client(session) for _ in range(CONNECTIONS)])
+    posted = time.monotonic() - started
+    await webhook.stop(timeout=60)
+    handled = time.monotonic() - started
+    session = await dp.bot.get_session()
+    await session.close()
+    print(f"{UPDATES} updates over {CONNECTIONS} connections, handler delay {HANDLER_DELAY} s, "
+          f"{webhook.concurrency} workers")
+    print(f"posted in {posted:.2f} s, handled in {handled:.2f} s: {webhook.handled / handled:.0f} updates/s, "
+          f"{webhook.failed} failed, at most {peak} handlers at once")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
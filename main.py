@@ -13,58 +13,47 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
 import traceback
-from datetime import datetime
+from functools import lru_cache
 from os import environ
-from typing import Awaitable, Callable, Optional
+from typing import Any, Optional
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.utils.exceptions import RetryAfter
 from aiorun import run
 
+from MessageQueue import MessageQueue
+from Subscriptions import Subscriptions
+from Webhook import Webhook
 from parsers import *
+from parsers import tables
+from parsers.ApplicantIndex import ApplicantIndex
+from parsers.Scheduler import Scheduler
+from parsers.allocation import shutdown_executor
 
 API_TOKEN = environ.get("TELEGRAM_TOKEN", "")
+MESSAGE_LIMIT = 4096
+ANSWER_CACHE_SIZE = int(environ.get("ANSWER_CACHE_SIZE", 4096))
+ESCAPE = str.maketrans({"-": r"\-", "(": r"\(", ")": r"\)", ".": r"\."})
 
 bot: Optional[Bot] = None
 dp: Optional[Dispatcher] = None
 parsers: list[BaseParser] = []
-count = 0
+scheduler: Optional[Scheduler] = None
+index: Optional[ApplicantIndex] = None
+outbox: Optional[MessageQueue] = None
+subscriptions: Optional[Subscriptions] = None
+webhook: Optional[Webhook] = None
 
 
-async def schedule_task(coro: Callable[[], Awaitable], interval: int):
-    while True:
-        await coro()
-        await asyncio.sleep(interval)
+def escape(text: str) -> str:
+    return text.translate(ESCAPE)
 
 
-async def run_update(parser: BaseParser):
-    while True:
-        try:
-            await schedule_task(parser.process_update, 3600)
-        except asyncio.CancelledError:
-            break
-        except Exception:
-            parser.last_update_failed = True
-            print(datetime.now().isoformat())
-            print(traceback.format_exc())
-            await asyncio.sleep(300)
+async def send_message(chat_id, message):
+    await outbox.put(chat_id, escape(message))
 
 
-async def send_message(chat_id, message):
-    global count
-    message = message.replace("-", r"\-").replace("(", r"\(").replace(")", r"\)").replace(".", r"\.")
-    while True:
-        try:
-            if count >= 26:
-                await asyncio.sleep(1)
-                if count >= 26:
-                    count = 0
-            await bot.send_message(chat_id, message, types.ParseMode.MARKDOWN_V2)
-        except RetryAfter as e:
-            await asyncio.sleep(1.5 * e.timeout)
-        else:
-            count += 1
-            break
+async def deliver(chat_id, message):
+    await bot.send_message(chat_id, message, types.ParseMode.MARKDOWN_V2)
 
 
 async def handle_telegram(message: types.Message):
@@ -74,75 +63,159 @@ async def handle_telegram(message: types.Message):
             answer += f"{parser.name}:\n" \
                       f"Last update started: {parser.last_update_started}\n" \
                       f"Last update failed: {parser.last_update_failed}\n" \
-                      f"Last update: {parser.last_update}\n\n"
+                      f"Last update: {parser.last_update}\n" \
+                      f"Connections: {parser.connections_created} new, {parser.connections_reused} reused\n" \
+                      f"Pages: {parser.pages_parsed} parsed, {parser.pages_not_modified} not modified, " \
+                      f"{parser.pages_unchanged} unchanged\n" \
+                      f"Hosts: {', '.join(str(i) for i in parser.limiters.values())}\n" \
+                      f"Specs refreshed: {parser.specs_refreshed}, failed: {parser.specs_failed}, " \
+                      f"reallocated: {parser.specs_reallocated}\n" \
+                      f"Stale specs: {', '.join(str(i) for i in parser.stale_specs) or '-'}\n" \
+                      f"Next update: {scheduler.next_run(parser)}\n" \
+                      f"Change rate: {scheduler.change_rate(parser):.2f}, " \
+                      f"interval {scheduler.interval(parser):.0f} s\n\n"
+        cache = render_applicant.cache_info()
+        if webhook is not None:
+            answer += f"Webhook: {webhook}\n"
+        answer += f"Subscriptions: {len(subscriptions)}\n" \
+                  f"Outbox: {outbox}\n" \
+                  f"Answer cache: {cache.currsize} answers, " \
+                  f"hit ratio {cache.hits / max(cache.hits + cache.misses, 1):.2f}\n"
         await send_message(message.chat.id, answer)
         return
-    app_id = message.text.replace("-", "").replace(" ", "")
+    app_id = ApplicantIndex.normalize(message.text)
+    found = index.lookup(app_id)
+    sections = []
+    for parser, specs in found.items():
+        parser.record_lookup(specs)
+        sections.append(render_applicant(parser, app_id, parser.snapshot_version))
+    if not sections:
+        sections.append(escape("Абитуриент не найден"))
     for parser in parsers:
-        answer = f"*{parser.name}:*\n"
+        if parser in found:
+            continue
         if parser.updating:
             if parser.last_update_failed:
-                answer += "Произошла ошибка при обновлении\n" \
-                          "Попробуйте через несколько минут"
-            else:
-                answer += "Обновляем списки, попробуйте через несколько секунд"
-            await send_message(message.chat.id, answer)
-            continue
-        applicant = parser.get_applicant(app_id)
-        if applicant == (None, None):
-            answer += "Абитуриент не найден"
-            await send_message(message.chat.id, answer)
-            continue
-        a = []
-        for i, j in enumerate(applicant[0].values()):
-            a.append((j, applicant[1][i] if applicant[1] else None))
-        for i, j in a:
-            spec = parser.get_spec(i[0])
-            places = spec["places"]
-            places_target = spec["places_target"]
-            places_spec = spec["places_spec"]
-            places_sep = spec["places_sep"]
-            places_base = places - places_target - places_spec - places_sep
-            if parser.processing:
-                predict = "Идёт обработка списков, попробуйте через минуту"
-            else:
-                predict = f"*{j}* место в конкурсном списке после распределения" if j \
-                    else "__*Поступил на более высокий приоритет*__"
-                if j:
-                    if j <= places_base:
-                        predict += "\n__*Поступил на это направление*__"
-            answer += f"__{spec['name']}:__\n" \
-                      f"Количество баллов с учётом ИД: _{i[1]}_\n" \
-                      f"*{i[2]}* место в текущем конкурсном списке\n" \
-                      f"Прогноз: {predict}\n" \
-                      f"Бюджетных мест: _{places}_\n" \
-                      f"Особая квота: _{places_spec}_\n" \
-                      f"Отдельная квота: _{places_sep}_\n" \
-                      f"Целевая квота: _{places_target}_\n" \
-                      f"Бюджетных мест в общем конкурсе: _{places_base}_\n"
-            if "count" in spec:
-                count = spec["count"]
-                count_target = spec["count_target"]
-                count_spec = spec["count_spec"]
-                count_sep = spec["count_sep"]
-                answer += f"Кол-во заявлений всего: _{count}_\n" \
-                          f"Кол-во заявлений по особой квоте: _{count_spec}_\n" \
-                          f"Кол-во заявлений по отдельной квоте: _{count_sep}_\n" \
-                          f"Кол-во заявлений по целевой квоте: _{count_target}_\n" \
-                          f"Кол-во БВИшников: _{spec['bvi'] if 'count_bvi' not in spec.keys() else spec['count_bvi']}_\n\n"
+                sections.append(escape(f"*{parser.name}:*\nПроизошла ошибка при обновлении\n"
+                                       f"Попробуйте через несколько минут"))
             else:
-                answer += f"Кол-во БВИшников: _{spec['bvi'] if 'count_bvi' not in spec.keys() else spec['count_bvi']}_\n\n"
-        answer += f"Обновлено: _{parser.last_update.isoformat(' ', 'seconds')}_"
-        await send_message(message.chat.id, answer)
+                sections.append(escape(f"*{parser.name}:*\nОбновляем списки, попробуйте через несколько секунд"))
+        elif not parser.complete:
+            sections.append(escape(f"*{parser.name}:*\nЗагружены ещё не все списки, попробуйте через несколько минут"))
+    for answer in join_sections(sections):
+        await outbox.put(message.chat.id, answer)
     print(f"request completed for: {message.text}")
 
 
+async def handle_subscribe(message: types.Message):
+    app_id = ApplicantIndex.normalize(message.get_args() or "")
+    if not app_id:
+        app_ids = subscriptions.of(message.chat.id)
+        await send_message(message.chat.id, f"Подписки: {', '.join(app_ids)}" if app_ids else
+                           "Использование: /subscribe СНИЛС\n"
+                           "Бот пришлёт сообщение, когда изменится место в списках или прогноз")
+    elif not ApplicantIndex.is_snils(app_id):
+        await send_message(message.chat.id, "СНИЛС должен состоять из 11 цифр")
+    elif await subscriptions.add(message.chat.id, app_id):
+        await send_message(message.chat.id, f"Подписка на {app_id} оформлена")
+    elif app_id in subscriptions.of(message.chat.id):
+        await send_message(message.chat.id, f"Подписка на {app_id} уже оформлена")
+    else:
+        await send_message(message.chat.id, f"Можно подписаться не больше чем на {subscriptions.per_chat} СНИЛС")
+
+
+async def handle_unsubscribe(message: types.Message):
+    app_id = ApplicantIndex.normalize(message.get_args() or "")
+    if ApplicantIndex.is_snils(app_id) and await subscriptions.remove(message.chat.id, app_id):
+        await send_message(message.chat.id, f"Подписка на {app_id} отменена")
+    else:
+        await send_message(message.chat.id, "Использование: /unsubscribe СНИЛС")
+
+
+async def notify_subscribers(parser: BaseParser, batches: dict[Any, list[str]]):
+    # One message per chat with every SNILS of it that changed in this update
+    for chat_id, app_ids in batches.items():
+        sections = [escape(f"Изменения по {app_id}:\n") + render_applicant(parser, app_id, parser.snapshot_version)
+                    for app_id in app_ids]
+        for answer in join_sections(sections):
+            await outbox.put(chat_id, answer)
+
+
+def join_sections(sections: list[str]) -> list[str]:
+    # As few messages as fit into the Telegram limit, the sections are already escaped
+    messages = []
+    for section in sections:
+        answer = f"{messages[-1]}\n\n{section}" if messages else section
+        if messages and len(answer) <= MESSAGE_LIMIT:
+            messages[-1] = answer
+        else:
+            messages.append(section)
+    return messages
+
+
+@lru_cache(maxsize=ANSWER_CACHE_SIZE)
+def render_applicant(parser: BaseParser, app_id: str, version: int) -> str:
+    # Escaped answer of one university, version changes with every snapshot the parser publishes
+    answer = f"*{parser.name}:*\n"
+    applicant = parser.applicants.get(app_id)
+    if applicant == (None, None):
+        return escape(answer + "Абитуриент не найден")
+    a = []
+    for i, j in enumerate(applicant[0].values()):
+        a.append((j, applicant[1][i] if applicant[1] else None))
+    for i, j in a:
+        spec = parser.get_spec(i[0])
+        places = spec["places"]
+        places_target = spec["places_target"]
+        places_spec = spec["places_spec"]
+        places_sep = spec["places_sep"]
+        places_base = places - places_target - places_spec - places_sep
+        if parser.processing:
+            predict = "Идёт обработка списков, попробуйте через минуту"
+        else:
+            predict = f"*{j}* место в конкурсном списке после распределения" if j \
+                else "__*Поступил на более высокий приоритет*__"
+            if j:
+                if j <= places_base:
+                    predict += "\n__*Поступил на это направление*__"
+        answer += f"__{spec['name']}:__\n" \
+                  f"Количество баллов с учётом ИД: _{i[1]}_\n" \
+                  f"*{i[2]}* место в текущем конкурсном списке\n" \
+                  f"Прогноз: {predict}\n" \
+                  f"Бюджетных мест: _{places}_\n" \
+                  f"Особая квота: _{places_spec}_\n" \
+                  f"Отдельная квота: _{places_sep}_\n" \
+                  f"Целевая квота: _{places_target}_\n" \
+                  f"Бюджетных мест в общем конкурсе: _{places_base}_\n"
+        updated = parser.get_spec_updated(i[0])
+        if updated != parser.last_update:
+            answer += f"Список направления от: _{updated.isoformat(' ', 'seconds') if updated else '—'}_\n"
+        if "count" in spec:
+            count = spec["count"]
+            count_target = spec["count_target"]
+            count_spec = spec["count_spec"]
+            count_sep = spec["count_sep"]
+            answer += f"Кол-во заявлений всего: _{count}_\n" \
+                      f"Кол-во заявлений по особой квоте: _{count_spec}_\n" \
+                      f"Кол-во заявлений по отдельной квоте: _{count_sep}_\n" \
+                      f"Кол-во заявлений по целевой квоте: _{count_target}_\n" \
+                      f"Кол-во БВИшников: _{spec['bvi'] if 'count_bvi' not in spec.keys() else spec['count_bvi']}_\n\n"
+        else:
+            answer += f"Кол-во БВИшников: _{spec['bvi'] if 'count_bvi' not in spec.keys() else spec['count_bvi']}_\n\n"
+    answer += f"Обновлено: _{parser.last_update.isoformat(' ', 'seconds')}_"
+    return escape(answer)
+
+
 async def main():
-    global bot, dp, parsers
+    global bot, dp, parsers, scheduler, index, outbox, subscriptions, webhook
 
     bot = Bot(token=API_TOKEN)
     dp = Dispatcher(bot)
+    dp.register_message_handler(handle_subscribe, commands=["subscribe"])
+    dp.register_message_handler(handle_unsubscribe, commands=["unsubscribe"])
     dp.register_message_handler(handle_telegram)
+    outbox = MessageQueue(deliver)
+    outbox.start()
 
     mpei_parser = MPEIParser()
     mirea_parser = MIREAParser()
@@ -150,32 +223,55 @@ async def main():
     mai_parser = MAIParser()
     mtuci_parser = MTUCIParser()
 
-    await mai_parser.init()
-    await mtuci_parser.init()
-
     parsers = [mpei_parser, mirea_parser, stankin_parser, mai_parser, mtuci_parser]
 
-    asyncio.create_task(dp.start_polling())
+    for parser in parsers:
+        parser.load_snapshot()
+    index = ApplicantIndex(parsers)
+    subscriptions = Subscriptions(parsers, notify_subscribers)
+    subscriptions.load()
+    # Handlers read the scheduler, it has to exist before the first update comes in
+    scheduler = Scheduler(parsers)
+    scheduler.start()
+
+    if environ.get("WEBHOOK_URL"):
+        webhook = Webhook(dp)
+        await webhook.start()
+    else:
+        asyncio.create_task(start_polling())
 
-    asyncio.create_task(run_update(mpei_parser))
-    await asyncio.sleep(5)
-    asyncio.create_task(run_update(mirea_parser))
-    await asyncio.sleep(5)
-    asyncio.create_task(run_update(stankin_parser))
-    await asyncio.sleep(5)
-    asyncio.create_task(run_update(mai_parser))
-    await asyncio.sleep(5)
-    asyncio.create_task(run_update(mtuci_parser))
+
+async def start_polling():
+    # A webhook left from webhook mode makes getUpdates fail
+    try:
+        await bot.delete_webhook()
+    except Exception:
+        print(traceback.format_exc())
+    await dp.start_polling()
 
 
 async def shutdown_callback(_):
-    if dp is not None:
+    if webhook is not None:
+        await webhook.stop()
+    elif dp is not None:
         dp.stop_polling()
         await dp.wait_closed()
+    if dp is not None:
         await dp.storage.close()
         await dp.storage.wait_closed()
+    if scheduler is not None:
+        await scheduler.stop()
+    if subscriptions is not None:
+        await subscriptions.stop()
+    if outbox is not None:
+        await outbox.stop()
+    if dp is not None:
         session = await dp.bot.get_session()
         await session.close()
+    for parser in parsers:
+        await parser.close()
+    shutdown_executor()
+    tables.shutdown_executor()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import traceback
+from typing import Any, Optional
+
+from parsers.ApplicantStore import ApplicantStore
+from parsers.BaseParser import BaseParser
+
+
+class ApplicantIndex:
+    # SNILS -> parsers and specs it is listed in, over all universities. The entries of a parser
+    # are replaced every time it publishes a snapshot, so a lookup only touches those parsers.
+    # Entries are built in a thread and only the difference is applied on the loop.
+    def __init__(self, parsers: list[BaseParser]):
+        self.parsers = parsers
+        self._index: dict[str, dict[BaseParser, tuple[Any, ...]]] = dict()
+        self._entries: dict[BaseParser, dict[str, tuple[Any, ...]]] = {parser: dict() for parser in parsers}
+        self._stale: set[BaseParser] = set()
+        self._tasks: dict[BaseParser, asyncio.Task] = dict()
+        for parser in parsers:
+            self._apply(parser, *self._diff(self._entries[parser], parser.applicants))
+            parser.add_publish_callback(self.update)
+
+    @staticmethod
+    def normalize(app_id: str) -> str:
+        return app_id.replace("-", "").replace(" ", "").strip()
+
+    @staticmethod
+    def is_snils(app_id: str) -> bool:
+        # Normalized SNILS, anything else is not safe to put into a MarkdownV2 answer
+        return len(app_id) == 11 and app_id.isascii() and app_id.isdigit()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @staticmethod
+    def _diff(old: dict[str, tuple[Any, ...]], applicants: Optional[ApplicantStore]) \
+            -> tuple[dict[str, tuple[Any, ...]], set[str], dict[str, tuple[Any, ...]]]:
+        entries = dict()
+        if applicants is not None:
+            for app_id, i in applicants.ids.items():
+                rows = range(applicants.offsets[i], applicants.offsets[i + 1])
+                if rows:
+                    entries[app_id] = tuple(applicants.specs[applicants.spec[r]] for r in rows)
+        removed = old.keys() - entries.keys()
+        changed = {app_id: specs for app_id, specs in entries.items() if old.get(app_id) != specs}
+        return entries, removed, changed
+
+    def _apply(self, parser: BaseParser, entries: dict[str, tuple[Any, ...]], removed: set[str],
+               changed: dict[str, tuple[Any, ...]]):
+        for app_id in removed:
+            del self._index[app_id][parser]
+            if not self._index[app_id]:
+                del self._index[app_id]
+        for app_id, specs in changed.items():
+            self._index.setdefault(app_id, dict())[parser] = specs
+        self._entries[parser] = entries
+
+    def update(self, parser: BaseParser):
+        # Snapshots published while a refresh runs are picked up by one more pass of it
+        self._stale.add(parser)
+        if parser not in self._tasks:
+            self._tasks[parser] = asyncio.create_task(self._refresh(parser))
+
+    async def _refresh(self, parser: BaseParser):
+        try:
+            while parser in self._stale:
+                self._stale.discard(parser)
+                self._apply(parser, *await asyncio.to_thread(self._diff, self._entries[parser], parser.applicants))
+        except Exception:
+            print(f"Failed to index {parser.name}")
+            print(traceback.format_exc())
+        finally:
+            del self._tasks[parser]
+
+    def lookup(self, app_id: str) -> dict[BaseParser, tuple[Any, ...]]:
+        found = self._index.get(self.normalize(app_id), {})
+        return {parser: found[parser] for parser in self.parsers if parser in found}
@@ -0,0 +1,131 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from array import array
+from typing import Any, Iterator, Mapping, Optional
+
+from parsers.allocation import index_positions
+
+NO_SCORE = -2 ** 31
+
+
+class ApplicantStore:
+    # Columnar form of the applicants and concurs lists: every SNILS is stored once and
+    # referred to by its integer id, one row per (applicant, priority), sorted by applicant.
+    def __init__(self,
+                 applicants: dict[str, dict[int, list[Any]]],
+                 concurs_lists: dict[Any, list[str]],
+                 final_lists: Optional[dict[Any, list[str]]] = None):
+        self.ids: dict[str, int] = dict()
+        self.specs: list[Any] = list(concurs_lists.keys())
+        self.offsets = array("I", [0])
+        self.spec = array("H")
+        self.priority = array("H")
+        self.score = array("i")
+        self.rank = array("I")
+        self.prediction = array("i")
+        self.other_scores: dict[int, Any] = dict()
+        self.predicted = final_lists is not None
+        self.count = len(applicants)
+
+        spec_index = {j: i for i, j in enumerate(self.specs)}
+        positions = index_positions(final_lists) if final_lists is not None else {}
+        for app_id, rows in applicants.items():
+            self.ids[app_id] = len(self.ids)
+            for priority, (spec, score, n) in sorted(rows.items(), key=lambda x: x[0]):
+                if spec not in spec_index:
+                    spec_index[spec] = len(self.specs)
+                    self.specs.append(spec)
+                if isinstance(score, int) and score != NO_SCORE:
+                    self.score.append(score)
+                else:
+                    self.other_scores[len(self.score)] = score
+                    self.score.append(NO_SCORE)
+                self.spec.append(spec_index[spec])
+                self.priority.append(priority)
+                self.rank.append(n)
+                self.prediction.append(positions.get(spec, {}).get(app_id, -1))
+            self.offsets.append(len(self.spec))
+
+        self.lists: dict[Any, array] = dict()
+        for spec, concurs_list in (final_lists if final_lists is not None else concurs_lists).items():
+            for app_id in concurs_list:
+                if app_id not in self.ids:
+                    self.ids[app_id] = len(self.ids)
+                    self.offsets.append(len(self.spec))
+            self.lists[spec] = array("I", [self.ids[app_id] for app_id in concurs_list])
+        self.app_ids = list(self.ids.keys())
+
+    def __contains__(self, app_id: str) -> bool:
+        i = self.ids.get(app_id)
+        return i is not None and self.offsets[i] != self.offsets[i + 1]
+
+    def __iter__(self) -> Iterator[str]:
+        return (app_id for app_id in self.app_ids if app_id in self)
+
+    def __getitem__(self, app_id: str) -> dict[int, list[Any]]:
+        return self.get(app_id)[0]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _score(self, row: int) -> Any:
+        if self.score[row] == NO_SCORE:
+            return self.other_scores[row]
+        return self.score[row]
+
+    def get(self, app_id: str) -> tuple[Optional[dict[int, list[Any]]], Optional[list[Optional[int]]]]:
+        i = self.ids.get(app_id)
+        if i is None or self.offsets[i] == self.offsets[i + 1]:
+            return None, None
+        rows = range(self.offsets[i], self.offsets[i + 1])
+        positions = {self.priority[r]: [self.specs[self.spec[r]], self._score(r), self.rank[r]] for r in rows}
+        if not self.predicted:
+            return positions, None
+        return positions, [self.prediction[r] if self.prediction[r] >= 0 else None for r in rows]
+
+    def priorities(self) -> Mapping[str, dict[int, Any]]:
+        # app_id -> {priority: spec} read from the rows, what the next allocation compares with
+        return PriorityView(self)
+
+    def concurs_list(self, spec: Any) -> list[str]:
+        return [self.app_ids[i] for i in self.lists.get(spec, ())]
+
+    def concurs_lists(self) -> dict[Any, list[str]]:
+        return {spec: self.concurs_list(spec) for spec in self.lists}
+
+    def positions(self, app_id: str) -> Optional[dict[Any, tuple[int, int]]]:
+        # Rank in the current list and predicted position of the applicant, spec by spec
+        i = self.ids.get(app_id)
+        if i is None or self.offsets[i] == self.offsets[i + 1]:
+            return None
+        return {self.specs[self.spec[r]]: (self.rank[r], self.prediction[r])
+                for r in range(self.offsets[i], self.offsets[i + 1])}
+
+
+class PriorityView(Mapping):
+    def __init__(self, store: ApplicantStore):
+        self.store = store
+
+    def __getitem__(self, app_id: str) -> dict[int, Any]:
+        i = self.store.ids.get(app_id)
+        if i is None or self.store.offsets[i] == self.store.offsets[i + 1]:
+            raise KeyError(app_id)
+        return {self.store.priority[r]: self.store.specs[self.store.spec[r]]
+                for r in range(self.store.offsets[i], self.store.offsets[i + 1])}
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
@@ -12,142 +12,468 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
+import hashlib
 import os
+import time
+import traceback
 from copy import deepcopy
 from datetime import datetime
-from typing import Optional, Any
+from os import environ
+from typing import Optional, Any, AsyncIterator, Awaitable, Callable, Iterable
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from parsers import tables
+from parsers.ApplicantStore import ApplicantStore
+from parsers.HostLimiter import HostLimiter
+from parsers.Snapshot import Snapshot
+from parsers.SpecScheduler import SpecScheduler
+from parsers.allocation import changed_specs, compact_priorities, list_digests, reallocate, run_in_executor
+from parsers.records import Record, build_lists
 
 
 class BaseParser:
     name: str
-    update_type: str
+    limit_per_host: int = 8
+    initial_concurrency: Optional[int] = None
+    max_retries: int = 3
+    progress_interval: float = 2
+    chunk_size: int = 64 * 1024
+    keepalive_timeout: float = 75
+    dns_cache_ttl: int = 600
 
     def __init__(self):
-        self._applicants: dict[str, dict[int, list[Any]]] = dict()
-        self._concurs_lists: dict[Any, list[str]] = dict()
         self._specs = dict()
         self._bvi = list()
-        self._updating_lists: bool = True
-        self._processing_lists: bool = True
+        self._records: dict[Any, list[Record]] = dict()
+        self._records_dirty = True
+        self._spec_scheduler = SpecScheduler()
+        self._specs_refreshed = 0
+        self._specs_failed = 0
+        self._spec_updated: dict[Any, datetime] = dict()
+        self._cycle = 0
+        self._progress_published = 0.0
+        self._progress_building = False
+        self._snapshot: Optional[Snapshot] = None
+        self._publish_callbacks: list[Callable[["BaseParser"], Any]] = []
+        self._snapshot_version = 0
         self._last_update: Optional[datetime] = None
         self.last_update_failed = False
         self._last_update_started = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._limiters: dict[str, HostLimiter] = dict()
+        self._connections_created = 0
+        self._connections_reused = 0
+        self._pages: dict[str, dict[str, Any]] = dict()
+        self._pages_parsed = 0
+        self._pages_not_modified = 0
+        self._pages_unchanged = 0
+        self._allocation: Optional[tuple] = None
+        self._specs_reallocated = 0
+        self._last_update_changed = False
 
     @property
     def updating(self):
-        return self._updating_lists
+        return self._snapshot is None
+
+    @property
+    def complete(self):
+        return self._snapshot is not None and self._snapshot.complete
 
     @property
     def processing(self):
-        return self._updating_lists or self._processing_lists
+        return self._snapshot is None or not self._snapshot.applicants.predicted
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def snapshot_version(self):
+        return self._snapshot_version
 
     @property
     def last_update(self):
-        return self._last_update
+        if self._snapshot is not None:
+            return self._snapshot.last_update
 
     @property
     def last_update_started(self):
         return self._last_update_started
 
+    @property
+    def connections_created(self):
+        return self._connections_created
+
+    @property
+    def connections_reused(self):
+        return self._connections_reused
+
+    @property
+    def limiters(self):
+        return self._limiters
+
+    @property
+    def pages_parsed(self):
+        return self._pages_parsed
+
+    @property
+    def pages_not_modified(self):
+        return self._pages_not_modified
+
+    @property
+    def pages_unchanged(self):
+        return self._pages_unchanged
+
+    @property
+    def pages_fetched(self):
+        return self._pages_parsed + self._pages_not_modified + self._pages_unchanged
+
+    @property
+    def specs_refreshed(self):
+        return self._specs_refreshed
+
+    @property
+    def specs_failed(self):
+        return self._specs_failed
+
+    @property
+    def stale_specs(self):
+        if self._snapshot is not None:
+            return self._snapshot.stale_specs()
+        return []
+
+    @property
+    def specs_reallocated(self):
+        return self._specs_reallocated
+
+    @property
+    def last_update_changed(self):
+        return self._last_update_changed
+
     @property
     def applicants(self):
-        return self._applicants
+        if self._snapshot is not None:
+            return self._snapshot.applicants
 
     def get_applicant(self, app_id: str):
-        if self._updating_lists:
-            return None, None
-        if app_id not in self._applicants:
+        if self._snapshot is None:
             return None, None
-        positions = self._applicants[app_id]
-        if self._processing_lists:
-            return positions, None
-        predictions = [self._concurs_lists[i[0]].index(app_id) if app_id in self._concurs_lists[i[0]]
-                       else None for i in self._applicants[app_id].values()]
-        return positions, predictions
+        applicant = self._snapshot.applicants.get(app_id)
+        if applicant[0] is not None:
+            self.record_lookup(i[0] for i in applicant[0].values())
+        return applicant
+
+    def record_lookup(self, specs: Iterable[Any]):
+        self._spec_scheduler.record_lookup(specs)
 
     def get_spec(self, spec_id: int):
-        if spec_id in self._specs:
-            return self._specs[spec_id]
-
-    async def update_lists(self):
-        self._updating_lists = True
-        self._processing_lists = True
-        self._applicants.clear()
-        self._concurs_lists = {i: [] for i in self._specs.keys()}
-        self._bvi.clear()
-        for i in self._specs.keys():
-            self._specs[i]["bvi"] = 0
-        match self.update_type:
-            case "parallel":
-                coro = []
-                for i in self._specs.keys():
-                    coro.append(self._parse_list(i))
-                await asyncio.gather(*coro)
-            case "series":
-                for i in self._specs.keys():
-                    await self._parse_list(i)
-            case _:
-                raise NotImplemented("Implement update_lists or set update_type")
+        if self._snapshot is not None and spec_id in self._snapshot.specs:
+            return self._snapshot.specs[spec_id]
+
+    def get_spec_updated(self, spec_id: Any) -> Optional[datetime]:
+        if self._snapshot is not None:
+            return self._snapshot.spec_updated.get(spec_id)
+
+    def add_publish_callback(self, callback: Callable[["BaseParser"], Any]):
+        self._publish_callbacks.append(callback)
+
+    def _published(self):
+        self._snapshot_version += 1
+        for callback in self._publish_callbacks:
+            try:
+                callback(self)
+            except Exception:
+                print(f"Publish callback of {self.name} failed")
+                print(traceback.format_exc())
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(environ.get("SNAPSHOT_DIR", "snapshots"), f"{type(self).__name__}.pickle")
+
+    def load_snapshot(self):
+        try:
+            self._snapshot = Snapshot.load(self.snapshot_path)
+            if self._snapshot is not None:
+                self._spec_updated = dict(self._snapshot.spec_updated)
+                self._cycle = self._snapshot.cycle
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print(f"Failed to load snapshot of {self.name}")
+            print(traceback.format_exc())
+
+    async def save_snapshot(self):
+        if not self._snapshot.complete:
+            return
+        try:
+            await asyncio.to_thread(self._snapshot.save, self.snapshot_path)
+        except Exception:
+            print(f"Failed to save snapshot of {self.name}")
+            print(traceback.format_exc())
+
+    async def init(self):
+        if self._session is not None:
+            return
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.__on_connection_create)
+        trace_config.on_connection_reuseconn.append(self.__on_connection_reuse)
+        connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         ttl_dns_cache=self.dns_cache_ttl,
+                                         resolver=aiohttp.AsyncResolver())
+        self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __on_connection_create(self, *_):
+        self._connections_created += 1
+
+    async def __on_connection_reuse(self, *_):
+        self._connections_reused += 1
+
+    async def _request(self, url: str, headers: dict,
+                       read: Optional[Callable[[aiohttp.ClientResponse], Awaitable[Any]]] = None
+                       ) -> tuple[aiohttp.ClientResponse, Any]:
+        # Every request goes through the limiter of its host; 429/5xx and connection errors are retried
+        host = urlsplit(url).hostname
+        if host not in self._limiters:
+            self._limiters[host] = HostLimiter(host, self.limit_per_host, self.initial_concurrency)
+        limiter = self._limiters[host]
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            started = time.monotonic()
+            try:
+                async with self._session.get(url, headers=headers) as resp:
+                    # Time to headers, reading and parsing the body say nothing about how loaded the host is
+                    latency = time.monotonic() - started
+                    body = await (read or aiohttp.ClientResponse.read)(resp)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                limiter.failure(started)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if resp.status != 429 and resp.status < 500:
+                    limiter.success(latency)
+                    return resp, body
+                retry_after = resp.headers.get("Retry-After", "")
+                limiter.failure(started, float(retry_after) if retry_after.isdigit() else None)
+                if attempt >= self.max_retries:
+                    resp.raise_for_status()
+            finally:
+                await limiter.release()
+            attempt += 1
+
+    async def _fetch(self, url: str, parse: Callable[[str], Any], headers: Optional[dict] = None) -> Any:
+        # Returns parse(html), reusing the previous result when the page has not changed since the last fetch
+        async def read(resp: aiohttp.ClientResponse) -> tuple[bytes, bytes]:
+            body = await resp.read()
+            return hashlib.blake2b(body, digest_size=16).digest(), body
+
+        async def parse_body(resp: aiohttp.ClientResponse, body: bytes) -> Any:
+            return await tables.run_in_executor(parse, body.decode(resp.get_encoding()))
+
+        return await self.__fetch(url, headers, read, parse_body)
+
+    async def _fetch_tables(self, url: str, parse: Callable[[list[tables.Table]], Any], headers: Optional[dict] = None,
+                            row_class: Optional[str] = None, recursive: bool = True) -> Any:
+        # Same as _fetch, but the rows are extracted in a thread while the body is still downloading,
+        # every chunk is fed while the next one is being read
+        async def read(resp: aiohttp.ClientResponse) -> tuple[bytes, list[tables.Table]]:
+            loop = asyncio.get_running_loop()
+            executor = tables.get_stream_executor()
+            digest = hashlib.blake2b(digest_size=16)
+            extractor = await loop.run_in_executor(executor, tables.backend.extractor, row_class, recursive,
+                                                   resp.charset)
+            feeding = None
+            async for chunk in resp.content.iter_chunked(self.chunk_size):
+                digest.update(chunk)
+                if feeding is not None:
+                    await feeding
+                feeding = loop.run_in_executor(executor, extractor.feed, chunk)
+            if feeding is not None:
+                await feeding
+            if extractor.picklable:
+                return digest.digest(), await tables.run_in_executor(extractor.close)
+            return digest.digest(), await loop.run_in_executor(executor, extractor.close)
+
+        async def parse_tables(_, result: list[tables.Table]) -> Any:
+            return parse(result)
+
+        return await self.__fetch(url, headers, read, parse_tables)
+
+    async def __fetch(self, url: str, headers: Optional[dict],
+                      read: Callable[[aiohttp.ClientResponse], Awaitable[tuple[bytes, Any]]],
+                      parse: Callable[[aiohttp.ClientResponse, Any], Awaitable[Any]]) -> Any:
+        headers = dict(headers or {})
+        page = self._pages.get(url)
+        if page is not None:
+            if page["etag"]:
+                headers["If-None-Match"] = page["etag"]
+            if page["last_modified"]:
+                headers["If-Modified-Since"] = page["last_modified"]
+        resp, (digest, data) = await self._request(url, headers, read)
+        if resp.status == 304 and page is not None:
+            self._pages_not_modified += 1
+            page["cycle"] = self._cycle
+            return page["result"]
+        if page is not None and page["digest"] == digest:
+            self._pages_unchanged += 1
+            page["cycle"] = self._cycle
+            page["etag"] = resp.headers.get("ETag")
+            page["last_modified"] = resp.headers.get("Last-Modified")
+            return page["result"]
+        result = await parse(resp, data)
+        self._pages[url] = {"etag": resp.headers.get("ETag"),
+                            "last_modified": resp.headers.get("Last-Modified"),
+                            "digest": digest,
+                            "result": result,
+                            "cycle": self._cycle}
+        self._pages_parsed += 1
+        return result
+
+    def _publish(self, applicants: ApplicantStore):
+        self._snapshot = Snapshot(deepcopy(self._specs), applicants, self._bvi, self._last_update,
+                                  dict(self._spec_updated), self._cycle)
+        self._published()
+
+    def _build_progress(self, finished: dict[Any, list[Record]], specs: dict[Any, dict]) -> Snapshot:
+        applicants, concurs_lists, bvi, values = build_lists(finished)
+        for i, j in values.items():
+            specs[i].update(j)
+        now = datetime.now()
+        return Snapshot(specs, ApplicantStore(applicants, concurs_lists), bvi, now,
+                        dict.fromkeys(finished, now), self._cycle, complete=False)
+
+    async def _publish_progress(self, finished: dict[Any, list[Record]]):
+        # Without a complete snapshot to answer from, finished specs are published as they come.
+        # Specs finishing while a build runs in the thread go into the next one.
+        if self._progress_building or self._snapshot is not None and self._snapshot.complete \
+                or time.monotonic() - self._progress_published < self.progress_interval:
+            return
+        self._progress_building = True
+        try:
+            specs = {i: deepcopy(j) for i, j in self._specs.items() if i in finished}
+            snapshot = await asyncio.to_thread(self._build_progress, dict(finished), specs)
+        finally:
+            self._progress_building = False
+        if self._snapshot is not None and self._snapshot.complete:
+            return
+        self._snapshot = snapshot
+        self._progress_published = time.monotonic()
+        self._published()
+
+    async def _update_specs(self):
+        pass
+
+    async def update_lists(self) -> tuple[dict[str, dict[int, list[Any]]], dict[Any, list[str]]]:
+        # Parsers only yield records, all the lists are built from them in one pass afterwards.
+        # The applicants and concurs lists are returned, the parser only keeps the published store.
+        self._cycle += 1
+        specs = self._spec_scheduler.select(self._specs.keys(), self._records.keys())
+        await self._update_specs()
+        records: dict[Any, list[Record]] = dict()
+
+        async def parse_list(i: Any):
+            records[i] = [row async for row in self._parse_list(i)]
+            await self._publish_progress(records)
+
+        results = await asyncio.gather(*[parse_list(i) for i in specs], return_exceptions=True)
+        refreshed = []
+        for i, result in zip(specs, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                print(f"Failed to update {self.name} {i}")
+                print("".join(traceback.format_exception(result)))
+            else:
+                refreshed.append(i)
+        if specs and not refreshed:
+            raise next(i for i in results if isinstance(i, Exception))
+        changed = {i for i in refreshed if i not in self._records or records[i] != self._records[i]}
+        for i in refreshed:
+            self._spec_scheduler.record_refresh(i, i in changed if i in self._records else None)
+        # Specs skipped or failed in this update keep the records of the previous one
+        records = {i: records[i] if i in records else self._records[i]
+                   for i in self._specs.keys() if i in records or i in self._records}
+        # Stays set until an allocation is made from the records, an update that fails before that
+        # must not leave the published lists behind the records
+        self._records_dirty = self._records_dirty or bool(changed) or records.keys() != self._records.keys()
+        self._records = records
+        self._specs_refreshed = len(refreshed)
+        self._specs_failed = len(specs) - len(refreshed)
+        # Pages not fetched since the oldest rows still in use were refreshed are not going to be asked for
+        # again, e.g. the ones of a prefix MAI stopped using. With every spec refreshed only this cycle's stay.
+        window = max((self._spec_scheduler.age(i) for i in self._records), default=0)
+        self._pages = {url: page for url, page in self._pages.items() if self._cycle - page["cycle"] <= window}
+
+        applicants, concurs_lists, self._bvi, values = await asyncio.to_thread(build_lists, self._records)
+        for i, j in values.items():
+            self._specs[i].update(j)
 
         self._last_update = datetime.now()
+        for i in refreshed:
+            self._spec_updated[i] = self._last_update
+        return applicants, {i: concurs_lists.get(i, []) for i in self._specs.keys()}
+
+    def _places_base(self, spec_id: Any) -> int:
+        spec = self._specs[spec_id]
+        if "count" in spec:
+            return spec["places"] \
+                - min(spec["places_target"], spec["count_target"]) \
+                - min(spec["places_spec"], spec["count_spec"]) \
+                - min(spec["places_sep"], spec["count_sep"]) \
+                - spec["bvi"]
+        return spec["places"] - spec["places_target"] - spec["places_spec"] - spec["places_sep"] - spec["bvi"]
 
-        for i in self._applicants.keys():
-            self._applicants[i] = dict(sorted(self._applicants[i].items(), key=lambda x: x[0]))
-        self._updating_lists = False
-
-    async def process_concurs_lists(self):
-        self._processing_lists = True
-        working_dict = deepcopy(self._applicants)
-        changed = True
-        while changed and not self._updating_lists:
-            changed = False
-            for i in self._specs.keys():
-
-                places = self._specs[i]["places"]
-                places_target = self._specs[i]["places_target"]
-                places_spec = self._specs[i]["places_spec"]
-                places_sep = self._specs[i]["places_sep"]
-                if "count" in self._specs[i]:
-                    count_target = self._specs[i]["count_target"]
-                    count_spec = self._specs[i]["count_spec"]
-                    count_sep = self._specs[i]["count_sep"]
-                    places_base = places \
-                                  - min(places_target, count_target) \
-                                  - min(places_spec, count_spec) \
-                                  - min(places_sep, count_sep) \
-                                  - self._specs[i]["bvi"]
-                else:
-                    places_base = places - places_target - places_spec - places_sep - self._specs[i]["bvi"]
-
-                for j in range(min(places_base, len(self._concurs_lists[i]))):
-                    app_id = self._concurs_lists[i][j]
-                    while self._concurs_lists[i].count(app_id) != 1:
-                        self._concurs_lists[i].remove(app_id)
-                        changed = True
-                    if app_id in self._bvi:
-                        changed = True
-                        self._concurs_lists[i].remove(app_id)
-                        continue
-                    priority = max(working_dict[app_id].keys())
-                    for k, v in working_dict[app_id].items():
-                        if v[0] == i:
-                            priority = k
-                            break
-                    for k in range(priority + 1, max(working_dict[app_id].keys()) + 1):
-                        if k in working_dict[app_id]:
-                            changed = True
-                            while self._concurs_lists[working_dict[app_id][k][0]].count(app_id) != 0:
-                                self._concurs_lists[working_dict[app_id][k][0]].remove(app_id)
-                            del working_dict[app_id][k]
-
-                await asyncio.sleep(0.02)
-        self._processing_lists = False
+    async def process_concurs_lists(self, applicants: dict[str, dict[int, list[Any]]],
+                                    concurs_lists: dict[Any, list[str]], places: dict[Any, int]) -> ApplicantStore:
+        # Only the specs reachable from what changed since the previous allocation are recomputed
+        priorities = await asyncio.to_thread(compact_priorities, applicants)
+        digests = await asyncio.to_thread(list_digests, concurs_lists)
+        bvi = set(self._bvi)
+        changed = set(concurs_lists.keys())
+        previous = None
+        if self._allocation is not None:
+            changed = await asyncio.to_thread(changed_specs, self._allocation[:4], priorities, concurs_lists, digests,
+                                              places, bvi)
+            previous = await asyncio.to_thread(self._allocation[4].concurs_lists)
+        final_lists, affected = await run_in_executor(reallocate, priorities, concurs_lists, places, bvi, previous,
+                                                      changed)
+        self._specs_reallocated = len(affected)
+        store = await asyncio.to_thread(ApplicantStore, applicants, concurs_lists, final_lists)
+        # The store has the priorities and final lists already, only the digests of the lists are kept besides it
+        self._allocation = (store.priorities(), digests, places, bvi, store)
+        return store
 
     async def process_update(self):
         self._last_update_started = datetime.now()
-        await self.update_lists()
-        await self.process_concurs_lists()
+        self._connections_created = 0
+        self._connections_reused = 0
+        self._pages_parsed = 0
+        self._pages_not_modified = 0
+        self._pages_unchanged = 0
+        self._specs_reallocated = 0
+        applicants, concurs_lists = await self.update_lists()
+        places = {i: self._places_base(i) for i in self._specs.keys()}
+        if self._records_dirty or self._allocation is None or places != self._allocation[2] \
+                or self._snapshot is None or not self._snapshot.complete:
+            store = await self.process_concurs_lists(applicants, concurs_lists, places)
+            self._records_dirty = False
+        else:
+            # The records and places are the ones of the published allocation, so is the allocation
+            store = self._snapshot.applicants
+        del applicants, concurs_lists
+        self._last_update_changed = self._snapshot is None or self._specs_reallocated > 0 \
+            or self._specs != self._snapshot.specs
+        self._publish(store)
         self.last_update_failed = False
+        await self.save_snapshot()
 
-    async def _parse_list(self, num: Any):
+    def _parse_list(self, num: Any) -> AsyncIterator[Record]:
         raise NotImplemented
@@ -0,0 +1,97 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+from typing import Optional
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class HostLimiter:
+    # Concurrency of requests to one host: grows by one per round of fast responses, shrinks when
+    # latency rises, halves and backs off exponentially on 429/5xx and connection errors.
+    # Requests already in flight when the host failed don't count again. After breaker_threshold
+    # failures in a row the host is not requested for breaker_timeout.
+    backoff_base = 1.0
+    max_backoff = 60.0
+    latency_tolerance = 3.0
+    breaker_threshold = 5
+    breaker_timeout = 300.0
+
+    def __init__(self, host: str, max_concurrency: int, concurrency: Optional[int] = None):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(concurrency or max_concurrency)
+        self.in_flight = 0
+        self.failures = 0
+        self.min_latency: Optional[float] = None
+        self.blocked_until = 0.0
+        self.failed_at = 0.0
+        self.open_until = 0.0
+        self._condition = asyncio.Condition()
+
+    @property
+    def open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def __str__(self):
+        return f"{self.host} x{self.concurrency:.1f}{' (open)' if self.open else ''}"
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.open or self.in_flight < int(self.concurrency))
+            if self.open:
+                raise CircuitOpenError(self.host)
+            self.in_flight += 1
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # The caller never gets the slot, so it never releases it either
+                await self.release()
+                raise
+        if self.open:
+            await self.release()
+            raise CircuitOpenError(self.host)
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def success(self, latency: float):
+        self.failures = 0
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if latency > self.latency_tolerance * self.min_latency:
+            self.concurrency = max(1.0, self.concurrency * 0.75)
+        else:
+            self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+
+    def failure(self, started: float, retry_after: Optional[float] = None):
+        if started < self.failed_at:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + (retry_after or 0))
+            return
+        self.failed_at = time.monotonic()
+        self.failures += 1
+        self.concurrency = max(1.0, self.concurrency / 2)
+        backoff = min(self.backoff_base * 2 ** (self.failures - 1), self.max_backoff)
+        self.blocked_until = time.monotonic() + max(backoff, retry_after or 0)
+        if self.failures >= self.breaker_threshold:
+            self.concurrency = 1.0
+            self.open_until = time.monotonic() + self.breaker_timeout
+            self.blocked_until = self.open_until
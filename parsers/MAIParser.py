@@ -11,104 +11,128 @@
 #
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+from typing import AsyncIterator, Optional
 
-import aiohttp
-from bs4 import BeautifulSoup
-
+from parsers import tables
 from parsers.BaseParser import BaseParser
+from parsers.records import ListType, Record, Row, SpecInfo
 
 
 class MAIParser(BaseParser):
     base_url = "https://public.mai.ru/priem/rating/data/{}_1_l1_p1_f1{}.html"
     prefix_url = "https://priem.mai.ru/rating/"
     name = "МАИ"
-    update_type = "parallel"
+    prefix_ttl = 600
+    prefix_max_backoff = 60
 
     def __init__(self):
         super().__init__()
+        self._prefix: Optional[str] = None
+        self._prefix_generation = 0
+        self._prefix_expires = 0.0
+        self._prefix_refresh: Optional[asyncio.Task] = None
+
+    async def __get_prefix(self, failed: Optional[int] = None) -> tuple[str, int]:
+        # All specs share one cached prefix. It is refreshed once its TTL runs out, or once per failed
+        # generation: tasks that failed with an already replaced prefix just take the new one
+        if self._prefix is not None and time.monotonic() < self._prefix_expires and failed != self._prefix_generation:
+            return self._prefix, self._prefix_generation
+        if self._prefix_refresh is None:
+            self._prefix_refresh = asyncio.create_task(self.__refresh_prefix())
+        return await asyncio.shield(self._prefix_refresh)
+
+    async def __refresh_prefix(self) -> tuple[str, int]:
+        try:
+            self._prefix = await self._fetch(self.prefix_url, self._parse_prefix)
+            self._prefix_generation += 1
+            self._prefix_expires = time.monotonic() + self.prefix_ttl
+            return self._prefix, self._prefix_generation
+        finally:
+            self._prefix_refresh = None
 
-    async def __get_prefix(self, session):
-        async with session.get(self.prefix_url) as resp:
-            html = await resp.text()
-            bs = BeautifulSoup(html, "html.parser")
-            select = bs.find("select", {"id": "place"})
-            option = select.find_all("option")[1]
-            return option["value"].split("_")[0]
+    @staticmethod
+    def _parse_prefix(html: str) -> str:
+        doc = tables.backend.parse(html)
+        option = tables.backend.elements(doc, "option", within=("select", {"id": "place"}))[1]
+        return option[1]["value"].split("_")[0]
 
     async def init(self):
-        async with aiohttp.ClientSession() as session:
-            prefix = await self.__get_prefix(session)
-            async with session.get(self.base_url.format(prefix, "")) as resp:
-                html = await resp.text()
-                bs = BeautifulSoup(html, "html.parser")
-                for i in bs.find_all("option")[1:]:
-                    self._specs[i["value"].split("_")[-1]] = {"name": i.text,
-                                                              "places": 0,
-                                                              "places_target": 0,
-                                                              "places_spec": 0,
-                                                              "places_sep": 0,
-                                                              "count": 0,
-                                                              "count_target": 0,
-                                                              "count_spec": 0,
-                                                              "count_sep": 0,
-                                                              "bvi": 0}
+        await super().init()
+        prefix, _ = await self.__get_prefix()
+        specs = await self._fetch(self.base_url.format(prefix, ""), self._parse_specs)
+        for spec_id, name in specs:
+            self._specs[spec_id] = {"name": name,
+                                    "places": 0,
+                                    "places_target": 0,
+                                    "places_spec": 0,
+                                    "places_sep": 0,
+                                    "count": 0,
+                                    "count_target": 0,
+                                    "count_spec": 0,
+                                    "count_sep": 0,
+                                    "bvi": 0}
 
-    async def _parse_list(self, num: str):
-        async with aiohttp.ClientSession() as session:
-            prefix = await self.__get_prefix(session)
-            async with session.get(self.base_url.format(prefix, f"_{num}")) as resp:
-                html = await resp.text()
-                bs = BeautifulSoup(html, "html.parser")
-                while True:
-                    try:
-                        p = bs.find_all("p")[1]
-                    except IndexError:
-                        prefix = await self.__get_prefix(session)
-                        async with session.get(self.base_url.format(prefix, f"_{num}")) as new_resp:
-                            html = await new_resp.text()
-                            bs = BeautifulSoup(html, "html.parser")
-                    else:
-                        break
-                for i in p.text.lower().replace("\t", "").replace("\n\n", "\n").split("\n"):
-                    if "количество мест" in i:
-                        self._specs[num]["places"] = int(i.split(":")[1].strip())
-                    elif "из них по особой квоте" in i:
-                        self._specs[num]["places_spec"] = int(i.split(":")[1].strip())
-                    elif "из них по отдельной квоте" in i:
-                        self._specs[num]["places_sep"] = int(i.split(":")[1].strip())
-                    elif "из них по целевой квоте" in i:
-                        self._specs[num]["places_target"] = int(i.split(":")[1].strip())
-                for table in bs.find_all("table"):
-                    table_header = table.find_previous("h4", {"class": "mt-5 mb-3"}).text
-                    parsed_table = [[col.text if row.attrs.get("class", "") != "agree"
-                                     else col.find("span", {"class": "notagree"})
-                                     for col in row.find_all("td")] for row in table.find_all("tr")]
-                    filtered = list(filter(lambda x: len(x) > 1, parsed_table))
-                    if "Лица, поступающие без вступительных экзаменов" in table_header:
-                        self._specs[num]["bvi"] = len(filtered)
-                        for row in filtered:
-                            app_id = row[1].replace("-", "").replace(" ", "").strip()
-                            if app_id not in self._bvi:
-                                self._bvi.append(app_id)
-                    elif "Лица, поступающие по особой квоте" in table_header:
-                        self._specs[num]["count_spec"] = len(filtered)
-                    elif "Лица, поступающие в рамках отдельной квоты приема" in table_header:
-                        self._specs[num]["count_sep"] = len(filtered)
-                    elif "Лица, поступающие в рамках квоты приема на целевое обучение" in table_header:
-                        self._specs[num]["count_target"] = len(filtered)
-                    elif "Лица, поступающие по общему конкурсу" in table_header:
-                        self._specs[num]["count"] = len(filtered)
-                        for row in filtered:
-                            app_id = row[1].replace("-", "").replace(" ", "").strip()
-                            priority = int(row[8])
-                            n = int(row[0])
-                            if app_id in self._bvi:
-                                continue
-                            score = int(row[2])
-                            if app_id not in self._applicants.keys():
-                                self._applicants[app_id] = {}
-                            self._applicants[app_id][priority] = [num, score, n]
-                            self._concurs_lists[num].append(app_id)
-                self._specs[num]["count"] += self._specs[num]["count_spec"] + self._specs[num]["count_sep"] + self._specs[num]["count_target"]
+    @staticmethod
+    def _parse_specs(html: str) -> list[tuple[str, str]]:
+        doc = tables.backend.parse(html)
+        return [(attrs["value"].split("_")[-1], text) for text, attrs in tables.backend.elements(doc, "option")[1:]]
 
+    async def _parse_list(self, num: str) -> AsyncIterator[Record]:
+        prefix, generation = await self.__get_prefix()
+        page = await self._fetch(self.base_url.format(prefix, f"_{num}"), self._parse_page)
+        delay = 1
+        for _ in range(self.max_retries):
+            if page is not None:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.prefix_max_backoff)
+            prefix, generation = await self.__get_prefix(failed=generation)
+            page = await self._fetch(self.base_url.format(prefix, f"_{num}"), self._parse_page)
+        if page is None:
+            raise ValueError(f"No list on the page of {num}")
+        info, page_tables = page
+        spec = {i: self._specs[num][i] for i in ("places", "places_spec", "places_sep", "places_target",
+                                                 "bvi", "count", "count_spec", "count_sep", "count_target")}
+        for i in info.lower().replace("\t", "").replace("\n\n", "\n").split("\n"):
+            if "количество мест" in i:
+                spec["places"] = int(i.split(":")[1].strip())
+            elif "из них по особой квоте" in i:
+                spec["places_spec"] = int(i.split(":")[1].strip())
+            elif "из них по отдельной квоте" in i:
+                spec["places_sep"] = int(i.split(":")[1].strip())
+            elif "из них по целевой квоте" in i:
+                spec["places_target"] = int(i.split(":")[1].strip())
+        rows = []
+        for table_header, filtered in page_tables:
+            if "Лица, поступающие без вступительных экзаменов" in table_header:
+                spec["bvi"] = len(filtered)
+                for row in filtered:
+                    app_id = row[1].replace("-", "").replace(" ", "").strip()
+                    rows.append(Row(num, ListType.bvi, app_id, None, None, int(row[0])))
+            elif "Лица, поступающие по особой квоте" in table_header:
+                spec["count_spec"] = len(filtered)
+            elif "Лица, поступающие в рамках отдельной квоты приема" in table_header:
+                spec["count_sep"] = len(filtered)
+            elif "Лица, поступающие в рамках квоты приема на целевое обучение" in table_header:
+                spec["count_target"] = len(filtered)
+            elif "Лица, поступающие по общему конкурсу" in table_header:
+                spec["count"] = len(filtered)
+                for row in filtered:
+                    app_id = row[1].replace("-", "").replace(" ", "").strip()
+                    rows.append(Row(num, ListType.base, app_id, int(row[8]), int(row[2]), int(row[0])))
+        spec["count"] += spec["count_spec"] + spec["count_sep"] + spec["count_target"]
+        yield SpecInfo(num, spec)
+        for row in rows:
+            yield row
 
+    @staticmethod
+    def _parse_page(html: str) -> Optional[tuple[str, list[tuple[str, list[list[str]]]]]]:
+        doc = tables.backend.parse(html)
+        try:
+            p = tables.backend.elements(doc, "p")[1][0]
+        except IndexError:
+            return None
+        return p, [(table.heading, list(filter(lambda x: len(x) > 1, table.rows)))
+                   for table in tables.backend.tables(doc, heading=("h4", "mt-5 mb-3"))]
@@ -12,15 +12,16 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import aiohttp
-from bs4 import BeautifulSoup
+from typing import AsyncIterator
 
+from parsers import tables
 from parsers.BaseParser import BaseParser
+from parsers.records import ListType, Record, Row, SpecInfo
 
 
 class MIREAParser(BaseParser):
     name = "РТУ МИРЭА"
-    update_type = "series"
+    initial_concurrency = 1
 
     def __init__(self):
         super().__init__()
@@ -507,34 +508,26 @@ class MIREAParser(BaseParser):
             }
         }
 
-    async def _parse_list(self, num: int):
-        async with aiohttp.ClientSession() as session:
-            if self._specs[num]["bvi_url"]:
-                async with session.get(self._specs[num]["bvi_url"]) as resp:
-                    html = await resp.text()
-                    bs = BeautifulSoup(html, "html.parser")
-                    table = bs.find("table")
-                    for n, row in enumerate(table.find_all("tr", recursive=False), start=1):
-                        cols = row.find_all("td")
-                        app_id = cols[1].text.replace("-", "").replace(" ", "").strip()
-                        priority = int(cols[2].text)
-                        if priority == 1:
-                            self._specs[num]["bvi"] += 1
-                            self._bvi.append(app_id)
-                            if app_id in self._applicants.keys():
-                                del self._applicants[app_id]
-            async with session.get(self._specs[num]["base_url"]) as resp:
-                html = await resp.text()
-                bs = BeautifulSoup(html, "html.parser")
-                table = bs.find("table")
-                for n, row in enumerate(table.find_all("tr", recursive=False), start=1):
-                    cols = row.find_all("td")
-                    app_id = cols[1].text.replace("-", "").replace(" ", "").strip()
-                    priority = int(cols[2].text)
-                    if app_id in self._bvi:
-                        continue
-                    score = int(cols[10].text)
-                    if app_id not in self._applicants.keys():
-                        self._applicants[app_id] = {}
-                    self._applicants[app_id][priority] = [num, score, n]
-                    self._concurs_lists[num].append(app_id)
+    async def _parse_list(self, num: int) -> AsyncIterator[Record]:
+        bvi = []
+        if self._specs[num]["bvi_url"]:
+            rows = await self._fetch_tables(self._specs[num]["bvi_url"], self._parse_tables, recursive=False)
+            bvi = [i for i in rows if i[1] == 1]
+        yield SpecInfo(num, {"bvi": len(bvi)})
+        for app_id, priority, score, n in bvi:
+            yield Row(num, ListType.bvi, app_id, priority, score, n)
+        rows = await self._fetch_tables(self._specs[num]["base_url"], self._parse_tables, recursive=False)
+        for app_id, priority, score, n in rows:
+            # BVI applicants have no score in the base list
+            yield Row(num, ListType.base, app_id, priority, int(score) if score is not None else None, n)
+
+    @staticmethod
+    def _parse_tables(page: list[tables.Table]) -> list[tuple]:
+        rows = []
+        table = page[0]
+        for n, cols in enumerate(table.rows, start=1):
+            app_id = cols[1].replace("-", "").replace(" ", "").strip()
+            priority = int(cols[2])
+            score = cols[10] if len(cols) > 10 else None
+            rows.append((app_id, priority, score, n))
+        return rows
@@ -12,13 +12,13 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
-from datetime import datetime
 from enum import Enum
+from functools import partial
+from typing import AsyncIterator
 
-import aiohttp
-from bs4 import BeautifulSoup
-
+from parsers import tables
 from parsers.BaseParser import BaseParser
+from parsers.records import ListType, Record, Row, SpecInfo
 
 
 class Types(Enum):
@@ -230,54 +230,32 @@ class MPEIParser(BaseParser):
             }
         }
 
-    async def update_lists(self):
-        self._updating_lists = True
-        self._processing_lists = True
-        self._applicants.clear()
-        self._concurs_lists = {i: [] for i in self._specs.keys()}
-        self._bvi.clear()
-        for i in self._specs.keys():
-            self._specs[i]["bvi"] = 0
-        coro = []
-        for i in self._specs.keys():
-            coro.append(self._parse_list(i, Types.base))
-            coro.append(self._parse_list(i, Types.bvi))
-        await asyncio.gather(*coro)
-
-        self._last_update = datetime.now()
+    async def _parse_list(self, num: int) -> AsyncIterator[Record]:
+        bvi, base = await asyncio.gather(self._fetch_list_type(num, Types.bvi), self._fetch_list_type(num, Types.base))
+        bvi = [i for i in bvi if i[1] == 1]
+        yield SpecInfo(num, {"bvi": len(bvi)})
+        for app_id, priority, score, n in bvi:
+            yield Row(num, ListType.bvi, app_id, priority, score, n)
+        for app_id, priority, score, n in base:
+            yield Row(num, ListType.base, app_id, priority, int(score), n)
 
-        for i in self._applicants.keys():
-            self._applicants[i] = dict(sorted(self._applicants[i].items(), key=lambda x: x[0]))
-        self._updating_lists = False
+    async def _fetch_list_type(self, num: int, list_type: Types) -> list[tuple]:
+        match list_type:
+            case Types.bvi | Types.base:
+                url = self.base_url.format(num, list_type.value)
+        return await self._fetch_tables(url, partial(self._parse_tables, list_type=list_type), row_class="accepted")
 
-    async def _parse_list(self, num: int, list_type: Types):
-        async with aiohttp.ClientSession() as session:
-            match list_type:
-                case Types.bvi | Types.base:
-                    url = self.base_url.format(num, list_type.value)
-            async with session.get(url) as resp:
-                html = await resp.text()
-                bs = BeautifulSoup(html, "html.parser")
-                for table in bs.find_all("table"):
-                    for n, row in enumerate(table.find_all("tr", {"class": "accepted"}), start=1):
-                        cols = row.find_all("td")
-                        if len(cols) not in [14, 15]:
-                            break
-                        app_id = cols[0].text.split(":")[1].strip()
-                        priority = int(cols[10].text if list_type == Types.spec else cols[11].text)
-                        if list_type == Types.bvi:
-                            if priority == 1:
-                                self._specs[num]["bvi"] += 1
-                                self._bvi.append(app_id)
-                                if app_id in self._applicants.keys():
-                                    del self._applicants[app_id]
-                        else:
-                            if app_id in self._bvi:
-                                continue
-                            score = int(cols[1].text) if list_type != Types.target else int(cols[2])
-                            if app_id not in self._applicants.keys():
-                                self._applicants[app_id] = {}
-                            self._applicants[app_id][priority] = [num, score, n]
-                            self._concurs_lists[num].append(app_id)
-                    else:
-                        break
+    @staticmethod
+    def _parse_tables(page: list[tables.Table], list_type: Types) -> list[tuple]:
+        rows = []
+        for table in page:
+            for n, cols in enumerate(table.rows, start=1):
+                if len(cols) not in [14, 15]:
+                    break
+                app_id = cols[0].split(":")[1].strip()
+                priority = int(cols[10] if list_type == Types.spec else cols[11])
+                score = cols[1] if list_type != Types.target else cols[2]
+                rows.append((app_id, priority, score, n))
+            else:
+                break
+        return rows
@@ -12,68 +12,67 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import aiohttp
-from bs4 import BeautifulSoup
+from typing import AsyncIterator
 
+from parsers import tables
 from parsers.BaseParser import BaseParser
+from parsers.records import ListType, Record, Row, SpecInfo
 
 
 class MTUCIParser(BaseParser):
     specs_url = "https://lk.abitur.mtuci.ru/mtuci-lists/view/"
     name = "МТУСИ"
-    update_type = "parallel"
 
     def __init__(self):
         super().__init__()
         self.cookie = "__jhash_=890;__hash__=f6a882200d1db1ef97599418d9caea2c"
 
     async def init(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.specs_url, headers={"Cookie": self.cookie}) as resp:
-                html = await resp.text()
-                bs = BeautifulSoup(html, "html.parser")
-                for i, j in enumerate(bs.find("div", {"class": "body-content"}).find_all("a")):
-                    self._specs[i] = {"name": j.text,
-                                      "url": f'https://lk.abitur.mtuci.ru{j["href"]}',
-                                      "places": 0,
-                                      "places_target": 0,
-                                      "places_spec": 0,
-                                      "places_sep": 0,
-                                      "bvi": 0}
+        await super().init()
+        specs = await self._fetch(self.specs_url, self._parse_specs, headers={"Cookie": self.cookie})
+        for i, (name, href) in enumerate(specs):
+            self._specs[i] = {"name": name,
+                              "url": f'https://lk.abitur.mtuci.ru{href}',
+                              "places": 0,
+                              "places_target": 0,
+                              "places_spec": 0,
+                              "places_sep": 0,
+                              "bvi": 0}
 
-    async def _parse_list(self, num: str):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self._specs[num]["url"], headers={"Cookie": self.cookie}) as resp:
-                html = await resp.text()
-                bs = BeautifulSoup(html, "html.parser")
-                try:
-                    span = bs.find("span", {"title": "Бюджетное финансирование"})
-                    self._specs[num]["places"] = int(span.text.strip())
-                    span = bs.find("span", {"title": "Целевое обучение"})
-                    self._specs[num]["places_target"] = int(span.text.strip())
-                    span = bs.find("span", {"title": "Особая квота"})
-                    self._specs[num]["places_spec"] = int(span.text.strip())
-                    span = bs.find("span", {"title": "Отдельная квота"})
-                    self._specs[num]["places_sep"] = int(span.text.strip())
-                    self._specs[num]["count_bvi"] = 0
-                except:
-                    breakpoint()
+    @staticmethod
+    def _parse_specs(html: str) -> list[tuple[str, str]]:
+        doc = tables.backend.parse(html)
+        return [(text, attrs["href"]) for text, attrs in
+                tables.backend.elements(doc, "a", within=("div", {"class": "body-content"}))]
 
-                table = bs.find("table")
-                parsed_table = [[col.text for col in row.find_all("td")] for row in table.find_all("tr")]
-                filtered = list(filter(lambda x: len(x) > 1, parsed_table))
-                for row in filtered:
-                    app_id = row[1].replace("-", "").replace(" ", "").strip()
-                    n = int(row[0])
-                    if len(row) != 6:
-                        a = len(row) - 11
-                        priority = int(row[9 + a].split("/")[0].strip())
-                        score = int(row[7 + a].replace("!", "").strip())
-                    else:
-                        priority = int(row[4].split("/")[0].strip())
-                        score = "БВИ"
-                        self._specs[num]["count_bvi"] += 1
-                    if app_id not in self._applicants.keys():
-                        self._applicants[app_id] = {}
-                    self._applicants[app_id][priority] = [num, score, n]
-                    self._concurs_lists[num].append(app_id)
+    async def _parse_list(self, num: str) -> AsyncIterator[Record]:
+        places, filtered = await self._fetch(self._specs[num]["url"], self._parse_page,
+                                             headers={"Cookie": self.cookie})
+        yield SpecInfo(num, dict(places, count_bvi=sum(len(row) == 6 for row in filtered)))
+        for row in filtered:
+            app_id = row[1].replace("-", "").replace(" ", "").strip()
+            n = int(row[0])
+            if len(row) != 6:
+                a = len(row) - 11
+                priority = int(row[9 + a].split("/")[0].strip())
+                score = int(row[7 + a].replace("!", "").strip())
+            else:
+                priority = int(row[4].split("/")[0].strip())
+                score = "БВИ"
+            yield Row(num, ListType.base, app_id, priority, score, n)
+
+    @staticmethod
+    def _parse_page(html: str) -> tuple[dict[str, int], list[list[str]]]:
+        doc = tables.backend.parse(html)
+        places = {}
+        span = tables.backend.elements(doc, "span", {"title": "Бюджетное финансирование"})[0][0]
+        places["places"] = int(span.strip())
+        span = tables.backend.elements(doc, "span", {"title": "Целевое обучение"})[0][0]
+        places["places_target"] = int(span.strip())
+        span = tables.backend.elements(doc, "span", {"title": "Особая квота"})[0][0]
+        places["places_spec"] = int(span.strip())
+        span = tables.backend.elements(doc, "span", {"title": "Отдельная квота"})[0][0]
+        places["places_sep"] = int(span.strip())
+
+        table = tables.backend.tables(doc)[0]
+        return places, list(filter(lambda x: len(x) > 1, table.rows))
@@ -12,12 +12,12 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
-from datetime import datetime
-
-import aiohttp
-from bs4 import BeautifulSoup
+from functools import partial
+from typing import AsyncIterator
 
+from parsers import tables
 from parsers.BaseParser import BaseParser
+from parsers.records import ListType, Record, Row
 
 
 class STANKINParser(BaseParser):
@@ -28,6 +28,7 @@ class STANKINParser(BaseParser):
                "PROPERTY_584=ready&LIST_TYPE=ranked&EDU_LEVEL=bs&PAGEN_1={}"
     stats_url = "https://priem.stankin.ru/bakalavriatispetsialitet/statistika/"
     name = "МГТУ \"СТАНКИН\""
+    page_concurrency = 4
 
     def __init__(self):
         super().__init__()
@@ -250,56 +251,44 @@ class STANKINParser(BaseParser):
             }
         }
 
-    async def update_lists(self):
-        self._updating_lists = True
-        self._processing_lists = True
-        self._applicants.clear()
-        self._concurs_lists = {i: [] for i in self._specs.keys()}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.stats_url) as resp:
-                html = await resp.text()
-                bs = BeautifulSoup(html, "html.parser")
-                table = bs.find("table")
-                for row in table.find_all("tr")[3:]:
-                    cols = row.find_all("td")
-                    if cols[0].text.strip() in self._specs.keys():
-                        self._specs[cols[0].text.strip()]["count"] = int(cols[3].text.strip())
-                        self._specs[cols[0].text.strip()]["count_target"] = int(cols[4].text.strip())
-                        self._specs[cols[0].text.strip()]["count_spec"] = int(cols[5].text.strip())
-                        self._specs[cols[0].text.strip()]["count_sep"] = int(cols[6].text.strip())
-                        self._specs[cols[0].text.strip()]["bvi"] = int(cols[7].text.strip())
+    async def _update_specs(self):
+        stats = await self._fetch(self.stats_url, self._parse_stats)
+        for cols in stats:
+            if cols[0] in self._specs.keys():
+                self._specs[cols[0]]["count"] = int(cols[3])
+                self._specs[cols[0]]["count_target"] = int(cols[4])
+                self._specs[cols[0]]["count_spec"] = int(cols[5])
+                self._specs[cols[0]]["count_sep"] = int(cols[6])
+                self._specs[cols[0]]["bvi"] = int(cols[7])
 
-        coro = []
-        for i in self._specs.keys():
-            coro.append(self._parse_list(i))
-        await asyncio.gather(*coro)
+    async def _parse_list(self, num: str) -> AsyncIterator[Record]:
+        semaphore = asyncio.Semaphore(self.page_concurrency)
 
-        self._last_update = datetime.now()
+        async def fetch_page(i: int) -> list[tuple]:
+            async with semaphore:
+                return await self._fetch(self.base_url.format(f"{num} {self._specs[num]['name']}", i),
+                                         partial(self._parse_page, page=i))
 
-        for i in self._applicants.keys():
-            self._applicants[i] = dict(sorted(self._applicants[i].items(), key=lambda x: x[0]))
-        self._updating_lists = False
+        pages = await asyncio.gather(*[fetch_page(i) for i in range(1, -(-self._specs[num]["count"] // 50) + 1)])
+        for rows in pages:
+            for n, app_id, priority, score in rows:
+                yield Row(num, ListType.base, app_id, priority, score, n)
 
-    async def _parse_list(self, num: str):
-        async with aiohttp.ClientSession() as session:
-            for i in range(1, (self._specs[num]["count"] // 50 + 1) if self._specs[num]["count"] % 50 == 0
-                           else (self._specs[num]["count"] // 50 + 2)):
-                async with session.get(self.base_url.format(f"{num} {self._specs[num]['name']}", i)) as resp:
-                    html = await resp.text()
-                    bs = BeautifulSoup(html, "html.parser")
-                    table = bs.find("table")
-                    tbody = table.find("tbody")
-                    for row in tbody.find_all("tr", recursive=False)[1:]:
-                        cols = row.find_all("td")
-                        n = int(cols[0].text.strip())
-                        if n == 1 and i != 1:
-                            break
-                        app_id = cols[1].text.replace("-", "").replace(" ", "").strip()
-                        priority = int(cols[3].text.strip())
-                        score = int(cols[6].text.strip())
+    @staticmethod
+    def _parse_stats(html: str) -> list[list[str]]:
+        table = tables.backend.tables(tables.backend.parse(html))[0]
+        return [[col.strip() for col in row] for row in table.rows[3:]]
 
-                        if app_id not in self._applicants.keys():
-                            self._applicants[app_id] = {}
-                        self._applicants[app_id][priority] = [num, score, n]
-                        if app_id not in self._concurs_lists[num]:
-                            self._concurs_lists[num].append(app_id)
+    @staticmethod
+    def _parse_page(html: str, page: int) -> list[tuple]:
+        rows = []
+        table = tables.backend.tables(tables.backend.parse(html), recursive=False, section="tbody")[0]
+        for cols in table.rows[1:]:
+            n = int(cols[0].strip())
+            if n == 1 and page != 1:
+                break
+            app_id = cols[1].replace("-", "").replace(" ", "").strip()
+            priority = int(cols[3].strip())
+            score = int(cols[6].strip())
+            rows.append((n, app_id, priority, score))
+        return rows
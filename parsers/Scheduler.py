@@ -0,0 +1,93 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import traceback
+from datetime import datetime, timedelta
+from os import environ
+from typing import Optional
+
+from parsers.BaseParser import BaseParser
+
+
+class Scheduler:
+    # Runs process_update of every parser on its own interval. The interval follows the observed
+    # share of updates that changed something, and all intervals are stretched together when the
+    # expected number of page fetches per hour exceeds the budget.
+    smoothing = 0.3
+
+    def __init__(self, parsers: list[BaseParser]):
+        self.min_interval = float(environ.get("UPDATE_MIN_INTERVAL", 600))
+        self.max_interval = float(environ.get("UPDATE_MAX_INTERVAL", 14400))
+        self.retry_interval = float(environ.get("UPDATE_RETRY_INTERVAL", 300))
+        self.stagger = float(environ.get("UPDATE_STAGGER", 5))
+        self.fetch_budget = float(environ.get("UPDATE_FETCH_BUDGET", 0))
+        self.parsers = parsers
+        self._change_rate = {parser: self.min_interval / 3600 for parser in parsers}
+        self._pages = {parser: 0 for parser in parsers}
+        self._next_run: dict[BaseParser, Optional[datetime]] = {parser: None for parser in parsers}
+        self._tasks: list[asyncio.Task] = []
+
+    def next_run(self, parser: BaseParser) -> Optional[datetime]:
+        return self._next_run[parser]
+
+    def change_rate(self, parser: BaseParser) -> float:
+        return self._change_rate[parser]
+
+    def _desired_interval(self, parser: BaseParser) -> float:
+        return self.min_interval / max(self._change_rate[parser], self.min_interval / self.max_interval)
+
+    def interval(self, parser: BaseParser) -> float:
+        interval = self._desired_interval(parser)
+        if self.fetch_budget > 0:
+            demand = sum(self._pages[i] * 3600 / self._desired_interval(i) for i in self.parsers)
+            if demand > self.fetch_budget:
+                interval *= demand / self.fetch_budget
+        return interval
+
+    def start(self):
+        now = datetime.now()
+        for n, parser in enumerate(self.parsers):
+            self._next_run[parser] = now + timedelta(seconds=n * self.stagger)
+            self._tasks.append(asyncio.create_task(self._run(parser)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _record(self, parser: BaseParser):
+        self._pages[parser] = parser.pages_fetched
+        self._change_rate[parser] += self.smoothing * (parser.last_update_changed - self._change_rate[parser])
+
+    async def _run(self, parser: BaseParser):
+        initialized = False
+        while True:
+            await asyncio.sleep(max((self._next_run[parser] - datetime.now()).total_seconds(), 0))
+            try:
+                if not initialized:
+                    await parser.init()
+                    initialized = True
+                await parser.process_update()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                parser.last_update_failed = True
+                initialized = False
+                print(datetime.now().isoformat())
+                print(traceback.format_exc())
+                self._next_run[parser] = datetime.now() + timedelta(seconds=self.retry_interval)
+                continue
+            self._record(parser)
+            self._next_run[parser] = datetime.now() + timedelta(seconds=self.interval(parser))
@@ -0,0 +1,60 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import pickle
+from datetime import datetime
+from typing import Any, Optional
+
+from parsers.ApplicantStore import ApplicantStore
+
+
+class Snapshot:
+    version = 4
+
+    # Read-only result of one update cycle. Parsers build the next cycle in their own buffers and
+    # replace the published snapshot at once. Until a parser has a complete one, it publishes
+    # incomplete snapshots of the cycle in progress: finished specs only, without predictions.
+    def __init__(self,
+                 specs: dict[Any, dict[str, Any]],
+                 applicants: ApplicantStore,
+                 bvi: list[str],
+                 last_update: datetime,
+                 spec_updated: dict[Any, datetime],
+                 cycle: int = 0,
+                 complete: bool = True):
+        self.specs = specs
+        self.applicants = applicants
+        self.bvi = bvi
+        self.last_update = last_update
+        self.spec_updated = spec_updated
+        self.cycle = cycle
+        self.complete = complete
+
+    def stale_specs(self) -> list[Any]:
+        return [i for i in self.specs if self.spec_updated.get(i) != self.last_update]
+
+    def save(self, path: str):
+        state = (self.version, self.specs, self.applicants, self.bvi, self.last_update, self.spec_updated, self.cycle)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Snapshot"]:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state[0] != cls.version:
+            return None
+        return cls(*state[1:])
@@ -0,0 +1,59 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import math
+from os import environ
+from typing import Any, Iterable, Optional
+
+
+class SpecScheduler:
+    # Picks the specs to refetch in an update: the ones applicants are looked up in and the ones
+    # that changed recently first, the rest keep their previous rows until they get old enough
+    smoothing = 0.3
+    demand_decay = 0.5
+
+    def __init__(self):
+        self.share = float(environ.get("SPEC_REFRESH_SHARE", 1))
+        self.max_age = int(environ.get("SPEC_MAX_AGE", 4))
+        self._demand: dict[Any, float] = dict()
+        self._volatility: dict[Any, float] = dict()
+        self._age: dict[Any, int] = dict()
+
+    def record_lookup(self, specs: Iterable[Any]):
+        for spec in specs:
+            self._demand[spec] = self._demand.get(spec, 0) + 1
+
+    def record_refresh(self, spec: Any, changed: Optional[bool]):
+        self._age[spec] = 0
+        if changed is not None:
+            volatility = self._volatility.get(spec, 1.0)
+            self._volatility[spec] = volatility + self.smoothing * (changed - volatility)
+
+    def score(self, spec: Any) -> float:
+        return (1 + self._demand.get(spec, 0)) * (self._volatility.get(spec, 1.0) + 0.1) * (self._age.get(spec, 0) + 1)
+
+    def select(self, specs: Iterable[Any], cached: Iterable[Any]) -> list[Any]:
+        specs = list(specs)
+        cached = set(cached)
+        forced = {i for i in specs if i not in cached or self._age.get(i, 0) + 1 >= self.max_age}
+        count = max(math.ceil(self.share * len(specs)), len(forced))
+        selected = forced.union(sorted((i for i in specs if i not in forced), key=self.score, reverse=True)
+                                [:count - len(forced)])
+        for i in specs:
+            self._age[i] = self._age.get(i, 0) + 1
+        for i in self._demand:
+            self._demand[i] *= self.demand_decay
+        return [i for i in specs if i in selected]
+
+    def age(self, spec: Any) -> int:
+        return self._age.get(spec, 0)
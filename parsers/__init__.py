@@ -1,4 +1,5 @@
 from .BaseParser import BaseParser
+from .Snapshot import Snapshot
 from .MPEIParser import MPEIParser
 from .MIREAParser import MIREAParser
 from .STANKINParser import STANKINParser
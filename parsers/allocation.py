@@ -0,0 +1,183 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import environ
+from typing import Any, Callable, Iterable, Mapping, Optional
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    # One pool for all parsers, so allocations of different universities run on different cores
+    global _executor
+    if _executor is None:
+        workers = environ.get("ALLOCATION_WORKERS")
+        # Forked workers would inherit the event loop, its sockets and the lists of every parser
+        _executor = ProcessPoolExecutor(max_workers=int(workers) if workers else None,
+                                        mp_context=multiprocessing.get_context("forkserver"))
+    return _executor
+
+
+async def run_in_executor(func: Callable, *args) -> Any:
+    # A worker killed by the OS breaks the whole pool for good, so it is replaced and the call is tried once more
+    global _executor
+    executor = get_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        if _executor is executor:
+            _executor = None
+            executor.shutdown(wait=False)
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+def compact_priorities(applicants: dict[str, dict[int, list[Any]]]) -> dict[str, dict[int, Any]]:
+    # Only the spec of every priority is needed for allocation, which keeps the pickled input small
+    return {app_id: {k: v[0] for k, v in j.items()} for app_id, j in applicants.items()}
+
+
+def list_digests(concurs_lists: dict[Any, list[str]]) -> dict[Any, bytes]:
+    # Enough to tell whether a list changed without keeping a copy of it
+    return {i: hashlib.blake2b("\n".join(j).encode(), digest_size=16).digest() for i, j in concurs_lists.items()}
+
+
+def index_positions(concurs_lists: dict[Any, list[str]]) -> dict[Any, dict[str, int]]:
+    return {i: {app_id: n for n, app_id in enumerate(j)} for i, j in concurs_lists.items()}
+
+
+def allocate(priorities: dict[str, dict[int, Any]],
+             concurs_lists: dict[Any, list[str]],
+             places: dict[Any, int],
+             bvi: Iterable[str]) -> dict[Any, list[str]]:
+    # Deferred acceptance: every spec offers its places to the top of its list,
+    # an applicant holding an offer is dropped from all specs of lower priority,
+    # and a spec that loses an offered applicant moves on to the next one.
+    bvi = set(bvi)
+    lists = {i: list(dict.fromkeys(j)) for i, j in concurs_lists.items()}
+    positions = {i: {app_id: n for n, app_id in enumerate(j)} for i, j in lists.items()}
+    removed = {i: set() for i in lists}
+    pointers = dict.fromkeys(lists, 0)
+    offered = dict.fromkeys(lists, 0)
+    best: dict[str, int] = {}
+    queue = deque(lists)
+
+    while queue:
+        spec = queue.popleft()
+        concurs_list = lists[spec]
+        while offered[spec] < places[spec] and pointers[spec] < len(concurs_list):
+            app_id = concurs_list[pointers[spec]]
+            pointers[spec] += 1
+            if app_id in removed[spec]:
+                continue
+            if app_id in bvi:
+                removed[spec].add(app_id)
+                continue
+            offered[spec] += 1
+            if app_id not in priorities:
+                continue
+
+            app_priorities = priorities[app_id]
+            priority = next((k for k, v in app_priorities.items() if v == spec), max(app_priorities.keys()))
+            if app_id in best and priority >= best[app_id]:
+                continue
+            worst = best.get(app_id, max(app_priorities.keys()))
+            best[app_id] = priority
+            for k, v in app_priorities.items():
+                if not priority < k <= worst or v not in removed or app_id in removed[v]:
+                    continue
+                removed[v].add(app_id)
+                if positions[v].get(app_id, pointers[v]) < pointers[v]:
+                    offered[v] -= 1
+                    queue.append(v)
+
+    return {i: [app_id for app_id in j if app_id not in removed[i]] for i, j in lists.items()}
+
+
+def changed_specs(previous: Optional[tuple[Mapping[str, dict[int, Any]], dict[Any, bytes], dict[Any, int], set[str]]],
+                  priorities: dict[str, dict[int, Any]], concurs_lists: dict[Any, list[str]],
+                  digests: dict[Any, bytes], places: dict[Any, int], bvi: set[str]) -> set[Any]:
+    # A spec has to be reallocated if rows were added, removed or re-ranked in its list,
+    # its places changed, or one of its applicants changed priorities or BVI status.
+    # previous holds the priorities, list digests, places and BVI of the previous allocation.
+    if previous is None or set(previous[1].keys()) != set(concurs_lists.keys()):
+        return set(concurs_lists.keys())
+    old_priorities, old_digests, old_places, old_bvi = previous
+    changed = {i for i in concurs_lists if old_digests[i] != digests[i] or old_places[i] != places[i]}
+    flipped = bvi ^ old_bvi
+    apps = set(flipped)
+    apps.update(app_id for app_id, j in priorities.items() if old_priorities.get(app_id) != j)
+    apps.update(app_id for app_id in old_priorities if app_id not in priorities)
+    for app_id in apps:
+        for j in (priorities.get(app_id), old_priorities.get(app_id)):
+            if j:
+                changed.update(i for i in j.values() if i in concurs_lists)
+    if flipped:
+        changed.update(i for i, j in concurs_lists.items() if i not in changed and not flipped.isdisjoint(j))
+    return changed
+
+
+def reallocate(priorities: dict[str, dict[int, Any]],
+               concurs_lists: dict[Any, list[str]],
+               places: dict[Any, int],
+               bvi: Iterable[str],
+               previous: Optional[dict[Any, list[str]]],
+               changed: set[Any]) -> tuple[dict[Any, list[str]], set[Any]]:
+    # An offer in one spec can only affect specs its applicants put at a lower priority, so
+    # everything not reachable that way from a changed spec keeps its previous final list
+    if previous is None or set(previous.keys()) != set(concurs_lists.keys()):
+        return allocate(priorities, concurs_lists, places, bvi), set(concurs_lists.keys())
+    affected = set(changed)
+    queue = deque(changed)
+    while queue and len(affected) < len(concurs_lists):
+        spec = queue.popleft()
+        for app_id in set(concurs_lists[spec]):
+            app_priorities = priorities.get(app_id)
+            if not app_priorities:
+                continue
+            priority = next((k for k, v in app_priorities.items() if v == spec), max(app_priorities.keys()))
+            for k, v in app_priorities.items():
+                if k > priority and v in concurs_lists and v not in affected:
+                    affected.add(v)
+                    queue.append(v)
+    if len(affected) == len(concurs_lists):
+        return allocate(priorities, concurs_lists, places, bvi), affected
+
+    # Applicants already holding an offer from an unaffected spec are out of its lower priorities
+    dropped = {i: set() for i in affected}
+    for spec, final_list in previous.items():
+        if spec in affected:
+            continue
+        for app_id in final_list[:max(places[spec], 0)]:
+            app_priorities = priorities.get(app_id)
+            if not app_priorities:
+                continue
+            priority = next((k for k, v in app_priorities.items() if v == spec), max(app_priorities.keys()))
+            for k, v in app_priorities.items():
+                if k > priority and v in dropped:
+                    dropped[v].add(app_id)
+    result = allocate(priorities, {i: [j for j in concurs_lists[i] if j not in dropped[i]] for i in affected},
+                      places, bvi)
+    return {i: result[i] if i in affected else previous[i] for i in concurs_lists}, affected
@@ -0,0 +1,67 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from enum import Enum
+from typing import Any, NamedTuple, Optional, Union
+
+
+class ListType(Enum):
+    base = "base"
+    bvi = "bvi"
+
+
+class Row(NamedTuple):
+    spec: Any
+    list_type: ListType
+    app_id: str
+    priority: Optional[int]
+    score: Any
+    rank: int
+
+
+class SpecInfo(NamedTuple):
+    # Counters and places of a spec read from its page
+    spec: Any
+    values: dict[str, Any]
+
+
+Record = Union[Row, SpecInfo]
+
+
+def build_lists(records: dict[Any, list[Record]]
+                ) -> tuple[dict[str, dict[int, list[Any]]], dict[Any, list[str]], list[str], dict[Any, dict[str, Any]]]:
+    # BVI rows of all specs are applied before any base row, so an applicant listed as BVI anywhere
+    # is left out of every base list whichever page came first
+    bvi = dict()
+    for rows in records.values():
+        for row in rows:
+            if isinstance(row, Row) and row.list_type == ListType.bvi:
+                bvi[row.app_id] = None
+
+    applicants = dict()
+    concurs_lists = dict()
+    specs = dict()
+    for spec, rows in records.items():
+        concurs_list = dict()
+        specs[spec] = dict()
+        for row in rows:
+            if isinstance(row, SpecInfo):
+                specs[spec].update(row.values)
+            elif row.list_type == ListType.base and row.app_id not in bvi:
+                applicants.setdefault(row.app_id, {})[row.priority] = [spec, row.score, row.rank]
+                concurs_list[row.app_id] = None
+        concurs_lists[spec] = list(concurs_list)
+
+    for app_id in applicants.keys():
+        applicants[app_id] = dict(sorted(applicants[app_id].items(), key=lambda x: x[0]))
+    return applicants, concurs_lists, list(bvi), specs
@@ -0,0 +1,243 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import environ
+from typing import Any, Callable, Optional
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+
+class Table:
+    def __init__(self, rows: list[list[str]], heading: Optional[str] = None):
+        self.rows = rows
+        self.heading = heading
+
+
+class Bs4Extractor:
+    # html.parser can't parse incrementally, so the body is only collected until close(),
+    # which can then run in the parse executor like any other parse
+    picklable = True
+
+    def __init__(self, row_class: Optional[str] = None, recursive: bool = True, encoding: Optional[str] = None):
+        self.row_class = row_class
+        self.recursive = recursive
+        self.encoding = encoding
+        self._chunks: list[bytes] = []
+
+    def feed(self, data: bytes):
+        self._chunks.append(data)
+
+    def close(self) -> list[Table]:
+        html = b"".join(self._chunks)
+        self._chunks = []
+        if not html:
+            return []
+        return Bs4Backend.tables(BeautifulSoup(html, "html.parser", from_encoding=self.encoding),
+                                 self.row_class, self.recursive)
+
+
+class LxmlExtractor:
+    # Collects table rows while the page is still being fed: every <tr> is converted to its cells
+    # as soon as it ends and then dropped from the tree, so the document is never held whole
+    picklable = False
+
+    def __init__(self, row_class: Optional[str] = None, recursive: bool = True, encoding: Optional[str] = None):
+        self.row_class = row_class
+        self.recursive = recursive
+        self._parser = lxml.etree.HTMLPullParser(events=("start", "end"), tag=("table", "tr"), encoding=encoding)
+        self._tables: list[Table] = []
+        self._stack: list[Table] = []
+        self._empty = True
+
+    def feed(self, data: bytes):
+        self._empty = self._empty and not data
+        self._parser.feed(data)
+        self._read()
+
+    def close(self) -> list[Table]:
+        if not self._empty:
+            self._parser.close()
+            self._read()
+        return self._tables
+
+    def _read(self):
+        for event, element in self._parser.read_events():
+            if element.tag == "table":
+                if event == "start":
+                    self._tables.append(Table([]))
+                    self._stack.append(self._tables[-1])
+                else:
+                    self._stack.pop()
+                continue
+            if event == "start" or not self._stack:
+                continue
+            if not self.row_class or LxmlBackend._matches(element, {"class": self.row_class}):
+                cells = ["".join(col.itertext()) for col in element.iter("td")]
+                if self.recursive:
+                    for table in self._stack:
+                        table.rows.append(cells)
+                elif element.getparent().tag == "table":
+                    self._stack[-1].rows.append(cells)
+            if len(self._stack) == 1:
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+
+class Bs4Backend:
+    name = "bs4"
+    extractor = Bs4Extractor
+
+    @staticmethod
+    def parse(html: str) -> Any:
+        return BeautifulSoup(html, "html.parser")
+
+    @staticmethod
+    def tables(doc: Any, row_class: Optional[str] = None, recursive: bool = True, section: Optional[str] = None,
+               heading: Optional[tuple[str, str]] = None) -> list[Table]:
+        result = []
+        for table in doc.find_all("table"):
+            container = table.find(section) if section else table
+            rows = container.find_all("tr", {"class": row_class} if row_class else {}, recursive=recursive)
+            caption = None
+            if heading:
+                caption = table.find_previous(heading[0], {"class": heading[1]}).text
+            result.append(Table([[col.text for col in row.find_all("td")] for row in rows], caption))
+        return result
+
+    @staticmethod
+    def elements(doc: Any, tag: str, attrs: Optional[dict[str, str]] = None,
+                 within: Optional[tuple[str, dict[str, str]]] = None) -> list[tuple[str, dict[str, str]]]:
+        if within:
+            doc = doc.find(within[0], within[1])
+        return [(i.text, {k: " ".join(v) if isinstance(v, list) else v for k, v in i.attrs.items()})
+                for i in doc.find_all(tag, attrs or {})]
+
+
+class LxmlBackend:
+    name = "lxml"
+    extractor = LxmlExtractor
+
+    @staticmethod
+    def parse(html: str) -> Any:
+        return lxml.html.document_fromstring(html)
+
+    @staticmethod
+    def _matches(element: Any, attrs: Optional[dict[str, str]]) -> bool:
+        for k, v in (attrs or {}).items():
+            value = element.get(k)
+            if value is None:
+                return False
+            if value != v and not (k == "class" and v in value.split()):
+                return False
+        return True
+
+    @classmethod
+    def tables(cls, doc: Any, row_class: Optional[str] = None, recursive: bool = True, section: Optional[str] = None,
+               heading: Optional[tuple[str, str]] = None) -> list[Table]:
+        result = []
+        for table in doc.iter("table"):
+            container = next(table.iter(section), None) if section else table
+            rows = container.iter("tr") if recursive else (i for i in container if i.tag == "tr")
+            caption = None
+            if heading:
+                caption = cls._preceding(table, heading)
+            result.append(Table([[col.text_content() for col in row.iter("td")]
+                                 for row in rows if cls._matches(row, {"class": row_class} if row_class else None)],
+                                caption))
+        return result
+
+    @classmethod
+    def _preceding(cls, element: Any, heading: tuple[str, str]) -> Optional[str]:
+        for i in element.itersiblings(preceding=True):
+            for j in reversed(list(i.iter(heading[0]))):
+                if cls._matches(j, {"class": heading[1]}):
+                    return j.text_content()
+        parent = element.getparent()
+        if parent is None:
+            return None
+        if parent.tag == heading[0] and cls._matches(parent, {"class": heading[1]}):
+            return parent.text_content()
+        return cls._preceding(parent, heading)
+
+    @classmethod
+    def elements(cls, doc: Any, tag: str, attrs: Optional[dict[str, str]] = None,
+                 within: Optional[tuple[str, dict[str, str]]] = None) -> list[tuple[str, dict[str, str]]]:
+        if within:
+            doc = next(i for i in doc.iter(within[0]) if cls._matches(i, within[1]))
+        return [(i.text_content(), dict(i.attrib)) for i in doc.iter(tag) if cls._matches(i, attrs) and i is not doc]
+
+
+backends = {Bs4Backend.name: Bs4Backend}
+if lxml is not None:
+    backends[LxmlBackend.name] = LxmlBackend
+
+backend = backends.get(environ.get("HTML_BACKEND", ""), backends.get(LxmlBackend.name, Bs4Backend))
+
+_executor: Optional[Executor] = None
+_stream_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> Executor:
+    # Pages are parsed off the event loop; PARSE_EXECUTOR=thread avoids pickling when lxml is available
+    global _executor
+    if _executor is None:
+        workers = environ.get("PARSE_WORKERS")
+        workers = int(workers) if workers else None
+        if environ.get("PARSE_EXECUTOR", "process") == "thread":
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parse")
+        else:
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+    return _executor
+
+
+async def run_in_executor(func: Callable, *args) -> Any:
+    # Same as allocation.run_in_executor, a broken pool is replaced and the page is parsed once more
+    global _executor
+    executor = get_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        if _executor is executor:
+            _executor = None
+            executor.shutdown(wait=False)
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+
+
+def get_stream_executor() -> ThreadPoolExecutor:
+    # Extractors keep their state between chunks, so they are fed in a thread instead of a process.
+    # An lxml parser must only be used in the thread it was created in, hence a single one.
+    global _stream_executor
+    if _stream_executor is None:
+        _stream_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="extract")
+    return _stream_executor
+
+
+def shutdown_executor():
+    global _executor, _stream_executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+    if _stream_executor is not None:
+        _stream_executor.shutdown(cancel_futures=True)
+        _stream_executor = None
@@ -0,0 +1,161 @@
+#  Copyright (c) 2023 pihta24 <admin@pihta24.ru>
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import random
+import unittest
+from typing import Any, Iterable
+
+from parsers.ApplicantStore import ApplicantStore
+from parsers.allocation import allocate, changed_specs, list_digests, reallocate
+
+CASES = 2000
+
+
+def fixed_point(priorities: dict[str, dict[int, Any]],
+                concurs_lists: dict[Any, list[str]],
+                places: dict[Any, int],
+                bvi: Iterable[str]) -> dict[Any, list[str]]:
+    # The loop process_concurs_lists ran before allocate, kept as the reference it has to match
+    lists = {i: list(j) for i, j in concurs_lists.items()}
+    working = {app_id: dict(j) for app_id, j in priorities.items()}
+    changed = True
+    while changed:
+        changed = False
+        for i in lists:
+            for j in range(min(places[i], len(lists[i]))):
+                app_id = lists[i][j]
+                while lists[i].count(app_id) != 1:
+                    lists[i].remove(app_id)
+                    changed = True
+                if app_id in bvi:
+                    changed = True
+                    lists[i].remove(app_id)
+                    continue
+                priority = max(working[app_id].keys())
+                for k, v in working[app_id].items():
+                    if v == i:
+                        priority = k
+                        break
+                for k in range(priority + 1, max(working[app_id].keys()) + 1):
+                    if k in working[app_id]:
+                        changed = True
+                        while lists[working[app_id][k]].count(app_id) != 0:
+                            lists[working[app_id][k]].remove(app_id)
+                        del working[app_id][k]
+    return lists
+
+
+def generate(r: random.Random, specs: int, applicants: int, bvi_share: float = 0.05) \
+        -> tuple[dict[str, dict[int, Any]], dict[Any, list[str]], dict[Any, int], set[str]]:
+    priorities = dict()
+    ranked = {i: [] for i in range(specs)}
+    bvi = set()
+    for n in range(applicants):
+        app_id = f"{n:011d}"
+        if r.random() < bvi_share:
+            bvi.add(app_id)
+        chosen = r.sample(range(specs), r.randint(1, min(5, specs)))
+        priorities[app_id] = {k: spec for k, spec in enumerate(chosen, 1)}
+        for spec in chosen:
+            ranked[spec].append((r.random(), app_id))
+    concurs_lists = {i: [app_id for _, app_id in sorted(j)] for i, j in ranked.items()}
+    places = {i: r.randint(-1, 15) for i in range(specs)}
+    return priorities, concurs_lists, places, bvi
+
+
+def mutate(r: random.Random, priorities: dict[str, dict[int, Any]], concurs_lists: dict[Any, list[str]],
+           places: dict[Any, int], bvi: set[str]) \
+        -> tuple[dict[str, dict[int, Any]], dict[Any, list[str]], dict[Any, int], set[str]]:
+    # What an update can do: applicants come, go, move in a list, change priorities or BVI status,
+    # specs change places. The arguments are left as they are.
+    priorities = {app_id: dict(j) for app_id, j in priorities.items()}
+    concurs_lists = {i: list(j) for i, j in concurs_lists.items()}
+    places = dict(places)
+    bvi = set(bvi)
+    specs = list(concurs_lists.keys())
+    for _ in range(r.randint(1, 3)):
+        action = r.randrange(5)
+        app_id = r.choice(list(priorities.keys())) if priorities else f"{r.randrange(10 ** 11):011d}"
+        if action == 0:
+            spec = r.choice(specs)
+            if concurs_lists[spec]:
+                concurs_lists[spec].insert(r.randint(0, len(concurs_lists[spec]) - 1), concurs_lists[spec].pop())
+        elif action == 1:
+            places[r.choice(specs)] = r.randint(-1, 15)
+        elif action == 2:
+            bvi ^= {app_id}
+        else:
+            for spec in priorities.pop(app_id, {}).values():
+                concurs_lists[spec].remove(app_id)
+            if action == 4:
+                chosen = r.sample(specs, r.randint(1, min(5, len(specs))))
+                priorities[app_id] = {k: spec for k, spec in enumerate(chosen, 1)}
+                for spec in chosen:
+                    concurs_lists[spec].insert(r.randint(0, len(concurs_lists[spec])), app_id)
+    return priorities, concurs_lists, places, bvi
+
+
+class AllocateTest(unittest.TestCase):
+    def test_higher_priority_offer_wins(self):
+        priorities = {"a": {1: 0, 2: 1}, "b": {1: 1}, "c": {1: 1}}
+        concurs_lists = {0: ["a"], 1: ["a", "b", "c"]}
+        self.assertEqual(allocate(priorities, concurs_lists, {0: 1, 1: 1}, set()), {0: ["a"], 1: ["b", "c"]})
+
+    def test_bvi_dropped_from_lists(self):
+        priorities = {"a": {1: 0}, "b": {1: 0}}
+        self.assertEqual(allocate(priorities, {0: ["a", "b"]}, {0: 1}, {"a"}), {0: ["b"]})
+
+    def test_matches_fixed_point(self):
+        r = random.Random(2023)
+        compared = 0
+        for case in range(CASES):
+            data = generate(r, r.randint(1, 8), r.randint(1, 60))
+            try:
+                expected = fixed_point(*data)
+            except IndexError:
+                # The old loop indexed past a list it had just shortened, there is nothing to compare with
+                continue
+            compared += 1
+            with self.subTest(case=case):
+                self.assertEqual(allocate(*data), expected)
+        self.assertGreater(compared, CASES // 2)
+
+
+def store(priorities: dict[str, dict[int, Any]], concurs_lists: dict[Any, list[str]],
+          final_lists: dict[Any, list[str]]) -> ApplicantStore:
+    applicants = {app_id: {k: [spec, 0, 0] for k, spec in j.items()} for app_id, j in priorities.items()}
+    return ApplicantStore(applicants, concurs_lists, final_lists)
+
+
+class ReallocateTest(unittest.TestCase):
+    def test_matches_allocate(self):
+        # The previous allocation is read back from its store and digests, as process_concurs_lists does
+        r = random.Random(2024)
+        for case in range(CASES):
+            priorities, concurs_lists, places, bvi = generate(r, r.randint(1, 8), r.randint(1, 60))
+            published = store(priorities, concurs_lists, allocate(priorities, concurs_lists, places, bvi))
+            previous = (published.priorities(), list_digests(concurs_lists), places, bvi)
+            for update in range(3):
+                priorities, concurs_lists, places, bvi = data = mutate(r, priorities, concurs_lists, places, bvi)
+                digests = list_digests(concurs_lists)
+                changed = changed_specs(previous, priorities, concurs_lists, digests, places, bvi)
+                lists, affected = reallocate(*data, published.concurs_lists(), changed)
+                with self.subTest(case=case, update=update):
+                    self.assertEqual(lists, allocate(*data))
+                    self.assertLessEqual(changed, affected)
+                published = store(priorities, concurs_lists, lists)
+                previous = (published.priorities(), digests, places, bvi)
+
+
+if __name__ == '__main__':
+    unittest.main()